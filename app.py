@@ -1,22 +1,131 @@
 
+import os
+import io
+import csv
+import json
+import queue
+import atexit
+import time
+import sqlite3
+import random
+import hashlib
+import secrets
+import cProfile
+import tempfile
+import threading
+import click
+from functools import wraps
+from urllib.parse import urlencode
+from collections import OrderedDict, namedtuple
+from itertools import groupby, islice, repeat
 from unicodedata import category
-from flask import Flask, render_template, url_for, redirect, request, session, flash
+from flask import Flask, render_template, url_for, redirect, request, session, flash, Response, stream_with_context, g, jsonify, has_request_context, abort
 from datetime import datetime
+from flask.sessions import SessionInterface, SecureCookieSession
+from werkzeug.http import is_resource_modified
+from flask.json.tag import TaggedJSONSerializer
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
+import bcrypt as bcrypt_lib
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import or_, desc, case, join, select
-from sqlalchemy.sql import func    
-from sqlalchemy.orm import aliased
+from sqlalchemy import or_, desc, case, join, select, insert, update, delete, literal, text, tuple_, event, bindparam
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import func, table, column
+from sqlalchemy.orm import aliased, joinedload, load_only
+from sqlalchemy.orm.attributes import set_committed_value
 
 
 app = Flask(__name__)
 bcrypt = Bcrypt(app)
 app.config['SECRET_KEY'] = "AVeryRandomSecretKey"
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///assignment3.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///assignment3.db').replace("postgres://", "postgresql://", 1)
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config.setdefault('DB_PROFILE', os.environ.get('DB_PROFILE', 'production')) # production or basic
+app.config.setdefault('DB_POOL_SIZE', int(os.environ.get('DB_POOL_SIZE', 10)))
+app.config.setdefault('DB_MAX_OVERFLOW', int(os.environ.get('DB_MAX_OVERFLOW', 20)))
+app.config.setdefault('SQLITE_PRAGMAS', {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 268435456,
+    "cache_size": -65536,
+    "temp_store": "MEMORY",
+})
+
+
+# DATABASE ENGINE
+# The production profile gives SQLite a real connection pool shared across
+# threads and sets SQLITE_PRAGMAS on every new connection. Pointing
+# DATABASE_URL at PostgreSQL runs the same models on a pooled server database.
+def engine_options(uri, profile):
+    if profile != "production":
+        return {}
+    url = make_url(uri)
+    options = {"pool_size": app.config['DB_POOL_SIZE'], "max_overflow": app.config['DB_MAX_OVERFLOW'], "pool_pre_ping": True}
+    if url.get_backend_name() == "sqlite":
+        options["poolclass"] = QueuePool
+        options["pool_pre_ping"] = False
+        options["connect_args"] = {"check_same_thread": False, "timeout": app.config['SQLITE_PRAGMAS'].get("busy_timeout", 5000) / 1000}
+    return options
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if app.config['DB_PROFILE'] == "production" and isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for name, value in app.config['SQLITE_PRAGMAS'].items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'], app.config['DB_PROFILE'])
 db = SQLAlchemy(app)
 
 
+def insert_missing(model):
+    # INSERT that skips rows whose primary key is already there, for rows that
+    # two requests may both find missing and fill in at once
+    dialect = db.engine.dialect.name
+    if dialect == "sqlite":
+        return sqlite.insert(model).on_conflict_do_nothing()
+    elif dialect == "postgresql":
+        return postgresql.insert(model).on_conflict_do_nothing()
+    return insert(model).prefix_with("IGNORE", dialect = "mysql")
+
+FEEDBACK_PAGE_SIZE = 50
+SMILE_PAGE_SIZE = 20
+REGRADE_PAGE_SIZE = 50
+app.config.setdefault('PRINCIPAL_CACHE_SIZE', 4096)
+app.config.setdefault('PRINCIPAL_CACHE_TTL', 300)
+app.config.setdefault('SMILE_FEED_TTL', 10)
+app.config.setdefault('PAGE_CACHE', os.environ.get('PAGE_CACHE', 'memory')) # memory, filesystem or none
+app.config.setdefault('PAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'assignment3-pages'))
+app.config.setdefault('PAGE_CACHE_SIZE', 2048)
+app.config.setdefault('PAGE_CACHE_TTL', 3600)
+app.config.setdefault('PAGE_CACHE_SWEEP_INTERVAL', 300)
+app.config.setdefault('BCRYPT_LOG_ROUNDS', int(os.environ.get('BCRYPT_LOG_ROUNDS', 12)))
+app.config.setdefault('BCRYPT_WORKERS', int(os.environ.get('BCRYPT_WORKERS', os.cpu_count() or 1))) # 0 hashes in the request thread
+app.config.setdefault('BCRYPT_QUEUE_DEPTH', app.config['BCRYPT_WORKERS'] * 4)
+app.config.setdefault('BCRYPT_TIMEOUT', 10)
+app.config.setdefault('IMPORT_CHUNK_SIZE', 1000)
+app.config.setdefault('SESSION_STORE', os.environ.get('SESSION_STORE', 'database')) # database, memory or cookie
+app.config.setdefault('SESSION_LIFETIME', 7 * 24 * 3600)
+app.config.setdefault('SESSION_SWEEP_INTERVAL', 300)
+app.config.setdefault('GRADING_STATUS_INTERVAL', 60)
+app.config.setdefault('FEEDBACK_ASYNC', os.environ.get('FEEDBACK_ASYNC') == "1")
+app.config.setdefault('FEEDBACK_QUEUE_SIZE', 10000)
+app.config.setdefault('FEEDBACK_DEDUPE_TTL', 60)
+app.config.setdefault('DEFAULT_COURSE_ID', int(os.environ.get('DEFAULT_COURSE_ID', 1)))
+app.config.setdefault('COURSE_CACHE_TTL', 600)
+app.config.setdefault('SLOW_QUERY_MS', float(os.environ.get('SLOW_QUERY_MS', 100)))
+app.config.setdefault('SLOW_QUERY_PARAMS_CHARS', 500)
+app.config.setdefault('PROFILE_SAMPLE_RATE', float(os.environ.get('PROFILE_SAMPLE_RATE', 0))) # fraction of requests to run under cProfile
+app.config.setdefault('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'assignment3-profiles'))
+
+
 # CREATE TABLES
 class User(db.Model):
     __tablename__ = 'User'
@@ -57,6 +166,11 @@ class Teacher(db.Model):
     tid = db.Column(db.Integer, primary_key = True)
     course_id = db.Column(db.Integer, db.ForeignKey('Course.cid') , nullable = False)
     teacher_id = db.Column(db.Integer, db.ForeignKey('User.uid') , nullable = False)
+
+    __table_args__ = (
+        db.Index('ix_teacher_user', 'teacher_id', 'course_id'),
+        db.Index('ix_teacher_course_user', 'course_id', 'teacher_id'),
+    )
     
     feedback = db.relationship("Feedback", backref = "feedbackTo", lazy = True)
     smile = db.relationship('Smile', backref = 'postedby')
@@ -70,6 +184,11 @@ class Student(db.Model):
     course_id = db.Column(db.Integer, db.ForeignKey('Course.cid') , nullable = False)
     student_id = db.Column(db.Integer, db.ForeignKey('User.uid') , nullable = False)
 
+    __table_args__ = (
+        db.Index('ix_student_user', 'student_id', 'course_id'),
+        db.Index('ix_student_course_user', 'course_id', 'student_id'),
+    )
+
     grade = db.relationship("Grade", backref = "gradeFor", lazy = True)
     feedback = db.relationship("Feedback", backref = "feedbackFrom", lazy = True)
 
@@ -102,6 +221,11 @@ class Grade(db.Model):
     asmt_id = db.Column(db.Integer, db.ForeignKey('Assignment.aid') , nullable = False)
     grade = db.Column(db.Float)
 
+    __table_args__ = (
+        db.Index('ix_grade_student_asmt', 'student_id', 'asmt_id'),
+        db.Index('ix_grade_asmt_grade', 'asmt_id', 'grade'),
+    )
+
 
     regrade = db.relationship("Regrade", backref = "regradeFor", lazy = True)
 
@@ -115,6 +239,11 @@ class Regrade(db.Model):
     reason = db.Column(db.Text, nullable = False)
     resolved = db.Column(db.Boolean, default = False, nullable = False)
 
+    __table_args__ = (
+        db.Index('ix_regrade_grade_resolved', 'grade_id', 'resolved'),
+        db.Index('ix_regrade_resolved_grade', 'resolved', 'grade_id'),
+    )
+
     def __repr__(self):
         return f"Regrade('{self.grade_id}' '{self.resolved}')"
 
@@ -127,6 +256,11 @@ class Feedback(db.Model):
     anonymous = db.Column(db.Boolean, default = True, nullable = False)
     feedback = db.Column(db.Text, nullable = False)
 
+    __table_args__ = (
+        db.Index('ix_feedback_teacher', 'teacher_id', 'fid'),
+        db.Index('ix_feedback_student', 'student_id'),
+    )
+
     def __repr__(self):
         return f"Feedback('{self.teacher_id}' '{self.category}')"
 
@@ -140,9 +274,817 @@ class Smile(db.Model):
     date_posted = db.Column(db.DateTime, nullable = False, default = datetime.utcnow)
     posted_by = db.Column(db.Integer, db.ForeignKey('Teacher.tid'), nullable = False)
 
+    __table_args__ = (
+        db.Index('ix_smile_posted', 'date_posted', 'hid'),
+    )
+
     def __repr__(self):
         return f"Smile('{self.date_posted}' '{self.title}')"
 
+class RegradeCount(db.Model):
+    # open regrade requests per assignment, kept up to date by the regrade routes
+    __tablename__ = "RegradeCount"
+    asmt_id = db.Column(db.Integer, db.ForeignKey('Assignment.aid'), primary_key = True)
+    open = db.Column(db.Integer, nullable = False, default = 0)
+
+    def __repr__(self):
+        return f"RegradeCount('{self.asmt_id}' '{self.open}')"
+
+class GradeSummary(db.Model):
+    # running totals behind the average / mark shown on the grades page
+    __tablename__ = "GradeSummary"
+    student_id = db.Column(db.Integer, db.ForeignKey('Student.sid'), primary_key = True)
+    assigned = db.Column(db.Integer, nullable = False, default = 0)
+    graded = db.Column(db.Integer, nullable = False, default = 0)
+    pct_sum = db.Column(db.Float, nullable = False, default = 0)
+    mark_sum = db.Column(db.Float, nullable = False, default = 0)
+
+    def sum_info(self):
+        average = self.pct_sum / self.graded if self.graded > 0 else 0
+        return ( round(average, 2), round(self.mark_sum, 2))
+
+    def __repr__(self):
+        return f"GradeSummary('{self.student_id}' '{self.graded}/{self.assigned}')"
+
+
+class StoredSession(db.Model):
+    # server-side session data, keyed by the random id in the session cookie
+    __tablename__ = "StoredSession"
+    id = db.Column(db.String(64), primary_key = True)
+    username = db.Column(db.String(20))
+    data = db.Column(db.Text, nullable = False)
+    expires = db.Column(db.Float, nullable = False)
+
+    __table_args__ = (
+        db.Index('ix_session_expires', 'expires'),
+        db.Index('ix_session_username', 'username'),
+    )
+
+    def __repr__(self):
+        return f"StoredSession('{self.username}' '{self.expires}')"
+
+
+
+# INSTRUMENTATION
+# Every request is timed and counts its SQL statements and SQL time through
+# engine events. Statements slower than SLOW_QUERY_MS are logged with their
+# first parameter set, capped at SLOW_QUERY_PARAMS_CHARS and with password,
+# session data and session id values masked. Per-route histograms are served in Prometheus text format at
+# /metrics, and a PROFILE_SAMPLE_RATE share of requests is run under cProfile
+# with the stats written to PROFILE_DIR.
+def label_text(names, values):
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return ",".join(pairs)
+
+
+class Counter:
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, values = (), amount = 1):
+        with self.lock:
+            self.series[values] = self.series.get(values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for values, total in sorted(self.series.items()):
+                lines.append(f"{self.name}{{{label_text(self.labels, values)}}} {total}" if values else f"{self.name} {total}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, values, amount):
+        with self.lock:
+            counts = self.series.setdefault(values, [0] * len(self.buckets) + [0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for values, counts in sorted(self.series.items()):
+                labels = label_text(self.labels, values)
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {counts[-2]}')
+                lines.append(f"{self.name}_sum{{{labels}}} {counts[-1]}")
+                lines.append(f"{self.name}_count{{{labels}}} {counts[-2]}")
+        return lines
+
+
+ROUTE_LABELS = ("route", "method")
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+metrics = {
+    "requests": Counter("app_requests_total", "Requests served.", ("route", "method", "status")),
+    "duration": Histogram("app_request_duration_seconds", "Time spent handling a request.", ROUTE_LABELS, SECONDS),
+    "queries": Histogram("app_request_queries", "SQL statements issued per request.", ROUTE_LABELS, (0, 1, 2, 3, 5, 10, 20, 50, 100)),
+    "sql": Histogram("app_request_sql_seconds", "Time spent in SQL per request.", ROUTE_LABELS, SECONDS),
+    "slow": Counter("app_slow_queries_total", "SQL statements slower than SLOW_QUERY_MS."),
+}
+
+
+# bind names are column names, with _1, _1_2... added for comparisons and IN lists
+SECRET_PARAMS = ("password", "data", "id")
+
+
+def describe_parameters(context, parameters, executemany):
+    # the first parameter set, by bind name where known, plus how many sets there were
+    compiled = context.compiled_parameters if context is not None and context.compiled is not None else None
+    if compiled:
+        described = repr({name: "***" if name.split("_")[0] in SECRET_PARAMS else value for name, value in compiled[0].items()})
+        count = len(compiled)
+    else:
+        # raw driver SQL has no bind names to mask by, so only the size is logged
+        described = "(%d values)" % len(parameters[0] if executemany and parameters else parameters or ())
+        count = len(parameters) if executemany else 1
+    limit = app.config['SLOW_QUERY_PARAMS_CHARS']
+    if len(described) > limit:
+        described = described[:limit] + "..."
+    return described + (f" and {count - 1} more parameter sets" if count > 1 else "")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_time += elapsed
+    if elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+        metrics["slow"].inc()
+        app.logger.warning("Slow query (%.1f ms): %s %s", elapsed * 1000, statement, describe_parameters(context, parameters, executemany))
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_time = 0.0
+    g.profiler = None
+    if app.config['PROFILE_SAMPLE_RATE'] and random.random() < app.config['PROFILE_SAMPLE_RATE']:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' not in g:
+        return response
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    labels = (route, request.method)
+    metrics["requests"].inc((route, request.method, response.status_code))
+    metrics["duration"].observe(labels, time.perf_counter() - g.request_start)
+    metrics["queries"].observe(labels, g.sql_queries)
+    metrics["sql"].observe(labels, g.sql_time)
+    if g.profiler is not None:
+        g.profiler.disable()
+        os.makedirs(app.config['PROFILE_DIR'], exist_ok = True)
+        name = f"{request.endpoint or 'unmatched'}-{time.time_ns()}.prof"
+        g.profiler.dump_stats(os.path.join(app.config['PROFILE_DIR'], name))
+    return response
+
+
+# BACKGROUND JOBS
+# One daemon thread runs every registered job on its own interval, the first
+# time as soon as the thread starts, which is on the first request. Jobs run
+# inside an app context with a fresh db.session each time; a failing job is
+# logged and tried again at its next interval.
+class Scheduler:
+    def __init__(self):
+        self.jobs = [] # [next run, interval, job]
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    def every(self, interval):
+        def register(job):
+            self.jobs.append([0, interval, job])
+            return job
+        return register
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None and self.jobs:
+                self.stopping.clear()
+                self.thread = threading.Thread(target = self.run, name = "scheduler", daemon = True)
+                self.thread.start()
+
+    def run(self):
+        with app.app_context():
+            while not self.stopping.is_set():
+                for entry in self.jobs:
+                    if entry[0] <= time.monotonic():
+                        entry[0] = time.monotonic() + entry[1]
+                        self.run_job(entry[2])
+                self.stopping.wait(max(min(entry[0] for entry in self.jobs) - time.monotonic(), 0))
+
+    def run_job(self, job):
+        try:
+            job()
+        except Exception:
+            app.logger.exception("Background job %s failed", job.__name__)
+        finally:
+            db.session.remove()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+scheduler = Scheduler()
+atexit.register(scheduler.stop)
+
+
+@app.before_request
+def start_scheduler():
+    scheduler.start()
+
+
+# SERVER-SIDE SESSIONS
+# With SESSION_STORE set to database or memory the session cookie only holds a
+# random id; the data lives in the StoredSession table or in this process. A
+# session is written when it changes, or when less than half of
+# SESSION_LIFETIME is left, so most requests only read it. Login stores the
+# resolved principal in the session and rotates the id. Deleting the stored
+# session revokes it on the next request, and a scheduler job deletes expired
+# sessions in bulk every SESSION_SWEEP_INTERVAL seconds.
+session_serializer = TaggedJSONSerializer()
+
+
+class ServerSideSession(SecureCookieSession):
+    def __init__(self, initial = None, sid = None, expires = None):
+        super().__init__(initial)
+        self.sid = sid
+        self.expires = expires
+
+
+class MemorySessionStore:
+    # per process, so only for a single worker
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def load(self, sid, now):
+        stored = self.sessions.get(sid)
+        if stored is None or stored[1] <= now:
+            return None
+        return session_serializer.loads(stored[0]), stored[1]
+
+    def save(self, sid, data, expires, username):
+        with self.lock:
+            self.sessions[sid] = (session_serializer.dumps(data), expires, username)
+
+    def delete(self, sid):
+        with self.lock:
+            return 1 if self.sessions.pop(sid, None) else 0
+
+    def delete_user(self, username):
+        with self.lock:
+            sids = [sid for sid, stored in self.sessions.items() if stored[2] == username]
+            for sid in sids:
+                del self.sessions[sid]
+        return len(sids)
+
+    def sweep(self, now):
+        with self.lock:
+            expired = [sid for sid, stored in self.sessions.items() if stored[1] <= now]
+            for sid in expired:
+                del self.sessions[sid]
+        return len(expired)
+
+
+class DatabaseSessionStore:
+    # shared by every process using the database; runs on its own connection so
+    # it never commits or rolls back the request's db.session
+    def __init__(self):
+        self.table = StoredSession.__table__
+        self.ready = False
+
+    def connect(self):
+        if not self.ready:
+            self.table.create(db.engine, checkfirst = True)
+            self.ready = True
+        return db.engine.begin()
+
+    def load(self, sid, now):
+        with self.connect() as conn:
+            row = conn.execute(select(self.table.c.data, self.table.c.expires).where(self.table.c.id == sid, self.table.c.expires > now)).first()
+        if row is None:
+            return None
+        return session_serializer.loads(row.data), row.expires
+
+    def save(self, sid, data, expires, username):
+        values = {"username": username, "data": session_serializer.dumps(data), "expires": expires}
+        with self.connect() as conn:
+            if not conn.execute(update(self.table).where(self.table.c.id == sid).values(**values)).rowcount:
+                conn.execute(insert(self.table).values(id = sid, **values))
+
+    def delete(self, sid):
+        with self.connect() as conn:
+            return conn.execute(delete(self.table).where(self.table.c.id == sid)).rowcount
+
+    def delete_user(self, username):
+        with self.connect() as conn:
+            return conn.execute(delete(self.table).where(self.table.c.username == username)).rowcount
+
+    def sweep(self, now):
+        with self.connect() as conn:
+            return conn.execute(delete(self.table).where(self.table.c.expires <= now)).rowcount
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            stored = self.store.load(sid, time.time())
+            if stored is not None:
+                return ServerSideSession(stored[0], sid = sid, expires = stored[1])
+        return ServerSideSession()
+
+    def save_session(self, app, session, response):
+        name = app.session_cookie_name
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain = domain, path = path)
+            return
+        now = time.time()
+        lifetime = app.config['SESSION_LIFETIME']
+        if not session.modified and session.sid is not None and session.expires - now > lifetime / 2:
+            return
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        session.expires = now + lifetime
+        self.store.save(session.sid, dict(session), session.expires, session.get('username'))
+        response.set_cookie(name, session.sid, expires = datetime.utcfromtimestamp(session.expires), httponly = self.get_cookie_httponly(app), domain = domain, path = path, secure = self.get_cookie_secure(app), samesite = self.get_cookie_samesite(app))
+
+
+def make_session_store(kind):
+    if kind == "database":
+        return DatabaseSessionStore()
+    elif kind == "memory":
+        return MemorySessionStore()
+    else:
+        return None
+
+session_store = make_session_store(app.config['SESSION_STORE'])
+if session_store is not None:
+    app.session_interface = ServerSessionInterface(session_store)
+
+    @scheduler.every(app.config['SESSION_SWEEP_INTERVAL'])
+    def sweep_sessions():
+        return session_store.sweep(time.time())
+
+
+def rotate_session():
+    # a fresh id at login and logout, so an id seen before cannot be reused
+    if session_store is not None and session.sid is not None:
+        session_store.delete(session.sid)
+        session.sid = None
+    session.clear()
+
+
+def start_session(principal):
+    rotate_session()
+    session['username'] = principal.username
+    session['type'] = principal.role
+    session['principal'] = tuple(principal)
+
+
+def revoke_user_sessions(username):
+    # signs the user out everywhere; cookie sessions cannot be revoked
+    forget_principal(username)
+    return session_store.delete_user(username) if session_store is not None else 0
+
+
+# LOGGED-IN PRINCIPAL
+# Each request resolves session['username'] once into g.principal (uid, tid or
+# sid, course and role). The principal stored at login is used as is for its
+# course; other lookups are cached per process by username and dropped on
+# register/logout, and the TTL bounds staleness across processes.
+class TTLCache:
+    def __init__(self, maxsize = 1024, ttl = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default = None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (self.ttl is not None and entry[1] < time.monotonic()):
+                self.entries.pop(key, None)
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.store(key, value)
+
+    def store(self, key, value):
+        # callers hold self.lock
+        expires = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last = False)
+
+    def add(self, key, value):
+        # set key only if it is absent or expired; returns whether it was set
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] >= time.monotonic():
+                return False
+            self.store(key, value)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+Principal = namedtuple("Principal", ["uid", "username", "firstname", "lastname", "role", "tid", "sid", "course_id"])
+
+principals = TTLCache(app.config['PRINCIPAL_CACHE_SIZE'], app.config['PRINCIPAL_CACHE_TTL'])
+
+
+def principal_query(username, course_id):
+    return db.session.query(User.uid, User.username, User.firstname, User.lastname, Teacher.tid, Student.sid).outerjoin(Teacher, (Teacher.teacher_id == User.uid) & (Teacher.course_id == course_id)).outerjoin(Student, (Student.student_id == User.uid) & (Student.course_id == course_id)).filter(User.username == username)
+
+
+def load_principal(username, course_id):
+    row = principal_query(username, course_id).first()
+    if row is None:
+        return None
+    role = "Student" if row.sid is not None else "Instructor" if row.tid is not None else None
+    return Principal(row.uid, row.username, row.firstname, row.lastname, role, row.tid, row.sid, course_id)
+
+
+def get_principal(username, course_id):
+    # cached per username as {course_id: Principal}
+    by_course = principals.get(username) or {}
+    if course_id not in by_course:
+        principal = load_principal(username, course_id)
+        if principal is None:
+            return None
+        by_course = dict(by_course)
+        by_course[course_id] = principal
+        principals.set(username, by_course)
+    return by_course[course_id]
+
+
+def forget_principal(username):
+    if username:
+        principals.delete(username)
+
+
+@app.before_request
+def resolve_principal():
+    stored = session.get('principal')
+    if stored is not None and stored[-1] == g.course_id:
+        g.principal = Principal(*stored)
+        return
+    username = session.get('username')
+    g.principal = get_principal(username, g.course_id) if username else None
+
+
+def current_role():
+    # the role in the current course; session['type'] only names the course logged into
+    return g.principal.role if g.principal else None
+
+
+def course_role():
+    # like current_role, but a logged-in user with no role in this course gets 403
+    role = current_role()
+    if role is None and session.get('username'):
+        abort(403)
+    return role
+
+
+# COURSES
+# Every route is also served under /course/<course_id>/; without the prefix
+# the request belongs to DEFAULT_COURSE_ID. The course is resolved before any
+# other hook into g.course_id, url_for keeps links inside it, and course rows
+# are cached per process so many courses cost no more than one.
+CourseInfo = namedtuple("CourseInfo", ["cid", "code", "name", "semester", "year"])
+
+course_cache = TTLCache(4096, app.config['COURSE_CACHE_TTL'])
+
+
+def course_info(course_id):
+    course = course_cache.get(course_id)
+    if course is None:
+        row = db.session.query(Course.cid, Course.code, Course.name, Course.semester, Course.year).filter(Course.cid == course_id).first()
+        if row is None:
+            return None
+        course = CourseInfo(*row)
+        course_cache.set(course_id, course)
+    return course
+
+
+def course_query(model, course_id = None):
+    # model.query limited to one course, the current request's by default
+    return model.query.filter(model.course_id == (g.course_id if course_id is None else course_id))
+
+
+@app.url_value_preprocessor
+def resolve_course(endpoint, values):
+    g.course_id = app.config['DEFAULT_COURSE_ID']
+    if values and 'course_id' in values:
+        g.course_id = values.pop('course_id')
+        if course_info(g.course_id) is None:
+            abort(404)
+
+
+@app.url_defaults
+def add_course_id(endpoint, values):
+    course_id = g.get('course_id')
+    if course_id is None or course_id == app.config['DEFAULT_COURSE_ID'] or 'course_id' in values:
+        return
+    if app.url_map.is_endpoint_expecting(endpoint, 'course_id'):
+        values['course_id'] = course_id
+
+
+def add_course_routes(exclude = ("static",)):
+    for rule in list(app.url_map.iter_rules()):
+        if rule.endpoint not in exclude and 'course_id' not in rule.arguments:
+            app.add_url_rule("/course/<int:course_id>" + rule.rule, endpoint = rule.endpoint, view_func = app.view_functions[rule.endpoint], methods = rule.methods)
+
+
+# PAGE CACHE
+# Rendered pages that only change when an instructor edits something are cached
+# by course, path, role and an optional per-view value; the query string only
+# counts for the args a view names, so made-up args cannot mint new entries.
+# Each cached view names the data tags it depends on; writes bump a tag's
+# generation, which changes the key of every page depending on it, so only
+# those pages miss afterwards. Every PAGE_CACHE_SWEEP_INTERVAL seconds the
+# filesystem backend deletes expired pages and the oldest beyond
+# PAGE_CACHE_SIZE; the memory backend is bounded by its LRU.
+class MemoryPageCache:
+    def __init__(self, maxsize, ttl):
+        self.pages = TTLCache(maxsize, ttl)
+        self.generations = {}
+
+    def get(self, key):
+        return self.pages.get(key)
+
+    def set(self, key, body):
+        self.pages.set(key, body)
+
+    def generation(self, tag):
+        return self.generations.get(tag, 0)
+
+    def bump(self, tag):
+        self.generations[tag] = time.time_ns()
+
+    def clear(self):
+        self.pages.clear()
+        self.generations.clear()
+
+    def sweep(self, now):
+        return 0
+
+    def __len__(self):
+        return len(self.pages.entries)
+
+
+class FilesystemPageCache:
+    # shared by every process pointed at the same directory; file names start
+    # with the kind of entry, so a sweep never deletes a tag's generation
+    def __init__(self, directory, maxsize, ttl):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok = True)
+
+    def path(self, key):
+        kind = key.split(":", 1)[0]
+        return os.path.join(self.directory, kind + "-" + hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def read(self, key, ttl = None):
+        path = self.path(key)
+        try:
+            if ttl is not None and os.path.getmtime(path) + ttl < time.time():
+                return None
+            with open(path, "rb") as file:
+                return file.read().decode("utf-8")
+        except OSError:
+            return None
+
+    def write(self, key, value):
+        with tempfile.NamedTemporaryFile(dir = self.directory, delete = False) as file:
+            file.write(value.encode("utf-8"))
+        os.replace(file.name, self.path(key))
+
+    def get(self, key):
+        return self.read("page:" + key, self.ttl)
+
+    def set(self, key, body):
+        self.write("page:" + key, body)
+
+    def generation(self, tag):
+        return int(self.read("generation:" + tag) or 0)
+
+    def bump(self, tag):
+        self.write("generation:" + tag, str(time.time_ns()))
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+
+    def sweep(self, now):
+        # expired pages, then the oldest pages beyond maxsize; returns how many were deleted
+        pages = []
+        for name in os.listdir(self.directory):
+            if name.startswith("page-"):
+                path = os.path.join(self.directory, name)
+                try:
+                    pages.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        pages.sort()
+        expired = sum(1 for mtime, path in pages if mtime + self.ttl < now)
+        doomed = pages[:max(expired, len(pages) - self.maxsize)]
+        for mtime, path in doomed:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return len(doomed)
+
+    def __len__(self):
+        return len(os.listdir(self.directory))
+
+
+# tags for data that belongs to no course; a bump reaches every course's pages
+GLOBAL_PAGE_TAGS = ("smiles",)
+
+
+class PageCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def tag(self, course_id, tag):
+        return tag if tag in GLOBAL_PAGE_TAGS else f"{course_id}:{tag}"
+
+    def key(self, course_id, endpoint, role, tags, vary):
+        generations = ".".join(str(self.backend.generation(self.tag(course_id, tag))) for tag in tags)
+        return f"{course_id}:{endpoint}:{role}:{vary}:{generations}"
+
+    def invalidate(self, course_id, *tags):
+        for tag in tags:
+            self.backend.bump(self.tag(course_id, tag))
+        self.invalidations += 1
+
+    def stats(self):
+        return {"backend": type(self.backend).__name__, "hits": self.hits, "misses": self.misses, "invalidations": self.invalidations, "entries": len(self.backend)}
+
+
+def make_page_cache(kind):
+    if kind == "memory":
+        return PageCache(MemoryPageCache(app.config['PAGE_CACHE_SIZE'], app.config['PAGE_CACHE_TTL']))
+    elif kind == "filesystem":
+        return PageCache(FilesystemPageCache(app.config['PAGE_CACHE_DIR'], app.config['PAGE_CACHE_SIZE'], app.config['PAGE_CACHE_TTL']))
+    else:
+        return None
+
+page_cache = make_page_cache(app.config['PAGE_CACHE'])
+if page_cache is not None:
+
+    @scheduler.every(app.config['PAGE_CACHE_SWEEP_INTERVAL'])
+    def sweep_page_cache():
+        return page_cache.backend.sweep(time.time())
+
+
+def cached_page(*tags, vary = None, args = ()):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # pages rendered with pending flash messages are neither served from nor stored in the cache
+            if page_cache is None or request.method != "GET" or session.get('_flashes'):
+                return view(*args, **kwargs)
+            # a logged-in user with no role in this course is keyed apart from visitors, so a
+            # page cached for a visitor is never served to someone the view would refuse
+            role = current_role() or ("none" if session.get('username') else None)
+            path = request.path + "?" + urlencode([(name, request.args.get(name, "")) for name in args])
+            key = page_cache.key(g.course_id, path, role, tags, vary() if vary else "")
+            body = page_cache.backend.get(key)
+            if body is not None:
+                page_cache.hits += 1
+                return app.response_class(body, mimetype = "text/html")
+            page_cache.misses += 1
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and response.mimetype == "text/html" and not session.get('_flashes'):
+                page_cache.backend.set(key, response.get_data(as_text = True))
+            return response
+        return wrapper
+    return decorator
+
+
+def invalidate_pages(*tags, course_id = None):
+    if page_cache is not None:
+        page_cache.invalidate(g.course_id if course_id is None else course_id, *tags)
+
+
+# PASSWORD HASHING
+# bcrypt is CPU bound, so hashing and checking run in a bounded process pool
+# instead of the request thread. At most BCRYPT_QUEUE_DEPTH jobs may be in
+# flight; beyond that, or when a job takes longer than BCRYPT_TIMEOUT,
+# PasswordPoolBusy is raised and the route answers 503. A job keeps its slot
+# until the worker finishes it, even when the request stopped waiting.
+class PasswordPoolBusy(Exception):
+    pass
+
+
+def hash_password_job(password, rounds):
+    # bcrypt only uses the first 72 bytes; older bcrypt releases truncated silently
+    return bcrypt_lib.hashpw(password.encode("utf-8")[:72], bcrypt_lib.gensalt(rounds)).decode("utf-8")
+
+
+def check_password_job(pw_hash, password):
+    if not pw_hash.startswith("$2"):
+        return False # imported without a password
+    return bcrypt_lib.checkpw(password.encode("utf-8")[:72], pw_hash.encode("utf-8"))
+
+
+password_pool = None
+password_pool_lock = threading.Lock()
+password_slots = threading.BoundedSemaphore(max(app.config['BCRYPT_QUEUE_DEPTH'], 1))
+
+
+def run_password_job(job, *args):
+    global password_pool
+    if app.config['BCRYPT_WORKERS'] <= 0:
+        return job(*args)
+    if not password_slots.acquire(blocking = False):
+        raise PasswordPoolBusy()
+    try:
+        with password_pool_lock:
+            if password_pool is None:
+                password_pool = ProcessPoolExecutor(max_workers = app.config['BCRYPT_WORKERS'])
+        future = password_pool.submit(job, *args)
+    except BaseException:
+        password_slots.release()
+        raise
+    future.add_done_callback(lambda future: password_slots.release())
+    try:
+        return future.result(timeout = app.config['BCRYPT_TIMEOUT'])
+    except FutureTimeoutError:
+        raise PasswordPoolBusy()
+
+
+def hash_password(password):
+    return run_password_job(hash_password_job, password, app.config['BCRYPT_LOG_ROUNDS'])
+
+
+def check_password(pw_hash, password):
+    return run_password_job(check_password_job, pw_hash, password)
 
 
 # ROUTING
@@ -150,12 +1092,12 @@ class Smile(db.Model):
     #SIMPLE PAGES
 @app.route("/")
 @app.route("/home")
+@cached_page("smiles", vary = lambda: g.principal.firstname if g.principal else "")
 def home():
-    course = Course.query.get(1) # this is just to show that the website can be modified to show different courses, controlled by admin
+    course = course_info(g.course_id) # this is just to show that the website can be modified to show different courses, controlled by admin
     name = ''
-    if session.get('username') :
-        user = User.query.filter_by(username = session.get('username')).first()
-        name = user.firstname
+    if g.principal :
+        name = g.principal.firstname
         
         return render_template('index.html', courseCode = course.code, courseName = course.name, courseSession = course.semester + " " + course.year, pagename = 'Home', name = name)
     else:
@@ -164,77 +1106,94 @@ def home():
 
 @app.route('/logout')
 def logout():
-    session.pop('username', default = None)
-    session.pop('type', default = None)
+    forget_principal(session.get('username'))
+    rotate_session()
     flash("You have been logged out", "Notice")
     return redirect(url_for('home'))
 
 @app.route("/syllabus")
+@cached_page()
 def syllabus():
     return render_template("syllabus.html", pagename = 'Syllabus')
 
 @app.route("/courseteam")
+@cached_page()
 def courseteam():
     return render_template("courseteam.html", pagename = 'Course Team')
 
 @app.route("/dailysmile", methods = ["POST", "GET"])
 def dailysmile():
     if request.method == "GET":
-        smiles = Smile.query.join(Teacher, Teacher.tid == Smile.posted_by).join(User, User.uid == Teacher.teacher_id).add_columns(User.firstname, User.lastname, Smile.title, Smile.link, Smile.type, Smile.desc, Smile.posted_by, Smile.date_posted, Smile.hid).order_by(Smile.date_posted.desc()).all()
-        return render_template("dailysmile.html", pagename = '😄 Daily Smile', smiles = smiles)
+        cursor = request.args.get('cursor', "")
+        as_json = request.args.get('format') == "json"
+        newest = latest_smile()
+        etag = f"smile-{newest[0] if newest else 0}-{current_role()}-{'json' if as_json else 'html'}-{cursor}"
+        last_modified = newest[1] if newest else None
+        # If-None-Match wins when sent, else If-Modified-Since is checked to the second
+        if not is_resource_modified(request.environ, etag, last_modified = last_modified) and not session.get('_flashes'):
+            return smile_feed_response(Response(status = 304), etag, last_modified)
+
+        smiles = smile_page(parse_smile_cursor(cursor))
+        next_cursor = smile_cursor(smiles[SMILE_PAGE_SIZE - 1]) if len(smiles) > SMILE_PAGE_SIZE else None
+        smiles = smiles[:SMILE_PAGE_SIZE]
+        if as_json:
+            response = app.response_class(json.dumps({"smiles": [smile_record(smile) for smile in smiles], "next": next_cursor}), mimetype = "application/json")
+        else:
+            response = app.make_response(render_template("dailysmile.html", pagename = '😄 Daily Smile', smiles = smiles, next_cursor = next_cursor))
+        return smile_feed_response(response, etag, last_modified)
     else:
-        if session.get('type') == "Instructor":
+        if course_role() != "Instructor":
+            abort(403)
+        else:
             title = request.form["title"]
             link = request.form['link']
             type = request.form['stype']
             desc = request.form['desc']
-            user = Teacher.query.join(User, User.uid == Teacher.teacher_id).filter(User.username == session.get('username')).first()
-            smile = Smile(title = title, link = link, type = type, desc = desc, posted_by = user.tid)
+            smile = Smile(title = title, link = link, type = type, desc = desc, posted_by = g.principal.tid)
             db.session.add(smile)
             db.session.commit()
+            smile_feed.set("latest", (smile.hid, smile.date_posted))
+            invalidate_pages("smiles")
             flash("New Smile added!", "Notice")
             return redirect(url_for('dailysmile'))
 
 @app.route('/feedback', methods = ['GET', 'POST'])
 def feedback():
     if session.get('username'):
-        if session.get('type') == "Instructor":
+        if course_role() == "Instructor":
             if request.method == "GET":
-                teacher = Teacher.query.join(User, User.uid == Teacher.teacher_id).filter(User.username == session.get('username')).first()
-                feedback = Feedback.query.join(Student, Feedback.student_id == Student.sid).join(User, User.uid == Student.student_id).add_columns(Feedback.feedback, Feedback.category,Feedback.anonymous, User.username).filter(Feedback.teacher_id == teacher.tid).order_by(Feedback.fid).all()  
+                feedback = teacher_feedback(g.principal.tid)
                 return render_template("feedback.html", pagename = 'Feedback', feedback = feedback, searchterm = "")
             else:
                 search = ""
                 if request.form.get('search'):
                     search = request.form.get('search')
-                teacher = Teacher.query.join(User, User.uid == Teacher.teacher_id).filter(User.username == session.get('username')).first()
 
-                feedback = Feedback.query.join(Student, Feedback.student_id == Student.sid).join(User, User.uid == Student.student_id).add_columns(Feedback.feedback, Feedback.category,Feedback.anonymous, User.username).filter(Feedback.teacher_id == teacher.tid).filter(or_(Feedback.category.like("%"+search+"%"), Feedback.feedback.like("%"+search+"%"))).order_by(Feedback.fid).all()  
+                page = request.form.get('page', 1, type = int)
+                feedback = search_feedback(g.principal.tid, search, page)
+                has_more = len(feedback) > FEEDBACK_PAGE_SIZE
                 flash(search, "Results for")
-                return render_template("feedback.html", pagename = 'Feedback', feedback = feedback , searchterm = search)
+                return render_template("feedback.html", pagename = 'Feedback', feedback = feedback[:FEEDBACK_PAGE_SIZE], searchterm = search, page = page, has_more = has_more)
 
         else:
             if request.method == "GET":
-                instructors = Teacher.query.join(User, User.uid == Teacher.teacher_id).add_columns(User.firstname, User.lastname, Teacher.tid).filter(Teacher.course_id == 1).order_by(User.firstname).all()
+                instructors = course_instructors(g.course_id)
                 return render_template("feedback.html", pagename = 'Feedback', instructors = instructors)
             else:
                 instructortid = request.form['instructor']
+                if instructortid != "all":
+                    try:
+                        instructortid = int(instructortid)
+                    except ValueError:
+                        abort(400)
+                    if instructortid not in {instructor.tid for instructor in course_instructors(g.course_id)}:
+                        abort(400)
                 category = request.form['category']
                 anonymous = 1 if request.form['anonymous'] == "Yes" else 0
                 feedback = request.form['feedback']
-                student = Student.query.join(User, User.uid == Student.student_id).filter(User.username == session.get('username')).first()
-                if instructortid == "all":
-                    instructors = Teacher.query.join(User, User.uid == Teacher.teacher_id).add_columns(User.firstname, User.lastname, Teacher.tid).filter(Teacher.course_id == 1).order_by(User.firstname).all()
-                    for instructor in instructors:
-                        feed = Feedback(teacher_id = instructor.tid, student_id = student.sid, category = category, anonymous = anonymous, feedback = feedback)
-                        db.session.add(feed)
-                        db.session.commit()
-                else:
-                    instructor = Teacher.query.get(instructortid)
-                    feed = Feedback(teacher_id = instructor.tid, student_id = student.sid, category = category, anonymous = anonymous, feedback = feedback)
-                    db.session.add(feed)
-                    db.session.commit()
-                    flash("Feedback submitted!", "Notice")
+                submission = FeedbackSubmission(g.principal.sid, instructortid, category, anonymous, feedback, g.course_id)
+                submit_feedback(submission, request.form.get('idempotency_key'))
+                flash("Feedback submitted!", "Notice")
                 return redirect(url_for('home'))
 
     else:
@@ -242,21 +1201,24 @@ def feedback():
         
 
 @app.route("/lectures")
+@cached_page()
 def lectures():
     return render_template("lectures.html", pagename = 'Lectures')
 
 @app.route("/tutorials")
+@cached_page()
 def tutorials():
     return render_template("tutorials.html", pagename = 'Tutorials')
 
 @app.route("/assignments")
+@cached_page("assignments", "grading")
 def assignments():
     if session.get('username'):
-        if session.get('type') == "Instructor" :
-            asmts = Assignment.query.filter_by(course_id = 1).all()
+        if course_role() == "Instructor" :
+            asmts = course_query(Assignment).all()
         else:
-            asmts = Assignment.query.filter_by(course_id = 1).filter(Assignment.name.like("Assignment%")).all()
-        return render_template("assignments.html", pagename = 'Assigmnents', asmts = asmts)
+            asmts = course_query(Assignment).filter(Assignment.name.like("Assignment%")).all()
+        return render_template("assignments.html", pagename = 'Assigmnents', asmts = asmts, status = grading_status(g.course_id))
     else:
         return render_template("assignments.html", pagename = 'Assigmnents')
 
@@ -266,14 +1228,21 @@ def assignments():
     #USERS
 @app.route("/requestregrade", methods = ['GET', 'POST'])
 def requestregrade():
+    if course_role() != "Student":
+        abort(403)
+    # students can only ask about their own grades in this course
+    grade = db.session.query(Assignment.name, Assignment.outof, Assignment.weight, Grade.grade, Grade.gid).join(Assignment, Assignment.aid == Grade.asmt_id).filter(Grade.gid == request.args.get('gid', type = int), Grade.student_id == g.principal.sid).first()
+    if grade is None:
+        abort(404)
 
     if request.method == "GET":
-        grade = Grade.query.filter_by(gid = request.args['gid']).join(Assignment, Assignment.aid == Grade.asmt_id).add_columns(Assignment.name, Assignment.outof, Assignment.weight, Grade.grade, Grade.gid).first()
         return render_template("request_regrade.html", pagename = "Reqeust Regrade", grade = grade)
     else:
         reason = request.form['reason']
-        regrade = Regrade(grade_id = request.args['gid'], reason = reason)
+        regrade = Regrade(grade_id = grade.gid, reason = reason)
         db.session.add(regrade)
+        db.session.flush()
+        update_regrade_count(regrade.grade_id, 1)
         db.session.commit()
         flash("Regrade request submitted.", "Notice")
         return redirect(url_for('grades'))
@@ -282,6 +1251,8 @@ def requestregrade():
     #INSTRUCTORS
 @app.route("/add_asmt", methods = ["GET", "POST"])
 def add_asmt():
+    if course_role() != "Instructor":
+        abort(403)
     if request.method == "GET":
         return render_template("add_asmt.html", pagename = "New Assignment")
     else:
@@ -292,7 +1263,7 @@ def add_asmt():
         asmt = (
             name, due, outof, weight
         )
-        add_asmt_db(asmt)
+        add_asmt_db(asmt, course_id = g.course_id)
         flash("Assignment added.", "Notice")
 
         return redirect(url_for("assignments"))
@@ -301,17 +1272,28 @@ def add_asmt():
 @app.route("/regrades", methods = ["GET", "POST"])
 def regrades():
     if request.method == "GET":
-        t_user = aliased(User)
-        s_user = aliased(User)
-
-        regrades = Regrade.query.join(Grade, Grade.gid == Regrade.grade_id).join(Student, Student.sid == Grade.student_id).join(Assignment, Assignment.aid == Grade.asmt_id).join(Course, Student.course_id == Course.cid).join(Teacher, Teacher.course_id == Course.cid).join(t_user, t_user.uid == Teacher.teacher_id).join(s_user, s_user.uid == Student.student_id).add_columns(Regrade.rid, Grade.gid, Regrade.resolved, Student.sid,  s_user.firstname.label("SFirst"), s_user.lastname.label("SLast"), Assignment.name, Assignment.outof, Grade.grade, Assignment.weight, Regrade.reason).filter(t_user.username == session.get('username')).order_by(Regrade.resolved, Assignment.name)
-
-        return render_template("regrades.html", pagename = 'Regrade Requests', regrades = regrades.all())
+        courses = (g.course_id,) if course_role() == "Instructor" else ()
+        status = request.args.get('status')
+        page = request.args.get('page', 1, type = int)
+        regrades = regrade_queue(courses, status, page)
+        has_more = len(regrades) > REGRADE_PAGE_SIZE
+        regrades = regrades[:REGRADE_PAGE_SIZE]
+        counts = regrade_counts(courses)
+        status = grading_status(g.course_id) if courses else {}
+
+        if request.args.get('format') == "json":
+            return jsonify(regrades = [regrade_record(regrade) for regrade in regrades], page = page, has_more = has_more, open = sum(counts.values()), per_assignment = counts, grading = [grading_status_record(asmt) for asmt in status.values()])
+        return render_template("regrades.html", pagename = 'Regrade Requests', regrades = regrades, page = page, has_more = has_more, open_counts = counts, status = status)
 
     else:
-        rid = request.form['rid']
-        regrade = Regrade.query.get(rid)
+        if course_role() != "Instructor":
+            abort(403)
+        rid = request.form.get('rid', type = int)
+        regrade = Regrade.query.options(load_only(Regrade.rid, Regrade.grade_id, Regrade.resolved)).join(Grade, Grade.gid == Regrade.grade_id).join(Assignment, Assignment.aid == Grade.asmt_id).filter(Regrade.rid == rid, Assignment.course_id == g.course_id).first()
+        if regrade is None:
+            abort(404)
         regrade.resolved = 1 if regrade.resolved == 0 else 0
+        update_regrade_count(regrade.grade_id, -1 if regrade.resolved else 1)
         db.session.commit()
         flash("Regrade request resolved.", "Notice")
 
@@ -320,39 +1302,40 @@ def regrades():
 
 @app.route("/edit_grade", methods = ["GET", "POST"])
 def edit_grade():
-    if session.get('type') == "Instructor":
-        students = Student.query.filter_by(course_id = 1).join(User, User.uid == Student.student_id).add_columns(User.firstname, User.lastname, Student.sid).order_by(User.lastname)
+    if course_role() == "Instructor":
         if request.method == "GET":
-            gid = request.args['gid']
-            student = Grade.query.join(Student, Student.sid == Grade.student_id).join(User, User.uid == Student.student_id).add_columns(Student.sid, User.firstname, User.lastname).filter(Grade.gid == gid).first()
-
-            grades = Grade.query.join(Assignment, Assignment.aid == Grade.asmt_id).add_columns(Assignment.aid, Assignment.name, Assignment.outof, Assignment.weight, Grade.gid, Grade.grade).join(Student, Student.sid == Grade.student_id).join(User, User.uid == Student.student_id).filter(Student.sid == student.sid).order_by(Assignment.name).all()
-
-            editgrade = Grade.query.join(Assignment, Assignment.aid == Grade.asmt_id).add_columns(Assignment.aid, Assignment.name, Assignment.outof, Assignment.weight, Grade.gid, Grade.grade).join(Student, Student.sid == Grade.student_id).join(User, User.uid == Student.student_id).filter(Student.sid == student.sid).filter(Grade.gid == gid).order_by(Assignment.name).first()
-
-            regrades = db.session.query(Regrade.grade_id, func.count(Regrade.rid).label("count")).join(Grade, Grade.gid == Regrade.grade_id).join(Student, Student.sid == Grade.student_id).where(Student.sid == student.sid).where(Regrade.resolved == 0).group_by(Grade.gid).all()
-            average = 0
-            num = 0 
-            mark = 0
-            for grade in grades:   
-                if grade.grade != None:
-                    average += grade.grade/grade.outof*100
-                    num += 1
-                    mark += grade.grade/grade.outof*grade.weight
-            if num > 0:
-                average = average / num
-            sum_info = ( round(average, 2), round(mark, 2)) 
+            gid = request.args.get('gid', type = int)
+            student = grade_student(gid, g.course_id)
+            if student is None:
+                abort(404)
+            students = course_students(g.course_id)
+            grades = student_grades(student.sid)
+            editgrade = next((grade for grade in grades if grade.gid == gid), None)
+            regrades = open_regrades_by_grade(student.sid)
+            sum_info = grade_summary(student.sid)
             return render_template("grades.html", pagename = 'Grades', students = students, grades = grades, sum_info = sum_info, studentshow = student, state = "edit", edittask = editgrade, regrades = regrades)
         else:
-            newgrade = request.form['newgrade']
-            gid = request.args['gid']
-            grade = Grade.query.get(gid)
-            grade.grade = newgrade
+            gid = request.args.get('gid', type = int)
+            # the assignment comes in the same query, so change_grade finds it in the session
+            grade = Grade.query.options(joinedload(Grade.gradeForAsmt).load_only(Assignment.outof, Assignment.weight)).join(Student, Student.sid == Grade.student_id).filter(Grade.gid == gid, Student.course_id == g.course_id).first()
+            if grade is None:
+                abort(404)
+            newgrade = request.form.get('newgrade', "").strip()
+            try:
+                newgrade = float(newgrade) if newgrade != "" else None
+            except ValueError:
+                flash("Grade must be a number.", "error")
+                return redirect(url_for('edit_grade', gid = gid))
+            outof = grade.gradeForAsmt.outof
+            if newgrade is not None and not 0 <= newgrade <= outof:
+                flash(f"Grade must be between 0 and {outof}.", "error")
+                return redirect(url_for('edit_grade', gid = gid))
+            change_grade(grade, newgrade)
+            sid = grade.student_id
             db.session.commit()
-            student = Grade.query.join(Student, Student.sid == Grade.student_id).join(User, User.uid == Student.student_id).add_columns(Student.sid, User.firstname, User.lastname).filter(Grade.gid == gid).first()
             flash("Grade changed.", "Notice")
             
-            return redirect(url_for('grades', sid = student.sid))
+            return redirect(url_for('grades', sid = sid))
 
     else:
         return redirect(url_for('grades'))
@@ -360,28 +1343,18 @@ def edit_grade():
 
 @app.route("/grades", methods = ['GET', 'POST'])
 def grades():
-    if session.get('type') == "Instructor":
-        students = Student.query.filter_by(course_id = 1).join(User, User.uid == Student.student_id).add_columns(User.firstname, User.lastname, Student.sid).order_by(User.lastname)
+    if course_role() == "Instructor":
         if request.method == "GET":
-            sid = students.first().sid
-            if request.args.get('sid'):
-                sid = request.args["sid"]
-             
-            student = students.filter(Student.sid == sid).first()                
-            grades = Grade.query.join(Assignment, Assignment.aid == Grade.asmt_id).add_columns(Assignment.aid, Assignment.name, Assignment.outof, Assignment.weight,  Grade.gid,Grade.grade).join(Student, Student.sid == Grade.student_id).join(User, User.uid == Student.student_id).filter(Student.sid == student.sid).order_by(Assignment.name).all()
-
-            regrades = db.session.query(Regrade.grade_id, func.count(Regrade.rid).label("count")).join(Grade, Grade.gid == Regrade.grade_id).join(Student, Student.sid == Grade.student_id).where(Student.sid == student.sid).where(Regrade.resolved == 0).group_by(Grade.gid).all()
-            average = 0
-            num = 0 
-            mark = 0
-            for grade in grades:   
-                if grade.grade != None:
-                    average += grade.grade/grade.outof*100
-                    num += 1
-                    mark += grade.grade/grade.outof*grade.weight
-            if num > 0:
-                average = average / num
-            sum_info = ( round(average, 2), round(mark, 2)) 
+            students = course_students(g.course_id)
+            sid = request.args.get('sid', type = int)
+            if sid is None and students:
+                sid = students[0].sid
+            student = next((row for row in students if row.sid == sid), None)
+            if student is None:
+                abort(404)
+            grades = student_grades(student.sid)
+            regrades = open_regrades_by_grade(student.sid)
+            sum_info = grade_summary(student.sid)
             return render_template("grades.html", pagename = 'Grades', students = students, grades = grades, sum_info = sum_info, studentshow = student, state = "view", regrades = regrades)
         else:
             student_id = request.form['student']
@@ -390,26 +1363,70 @@ def grades():
     else:
         if request.method == "GET":
 
-            grades = Grade.query.join(Assignment, Assignment.aid == Grade.asmt_id).add_columns(Assignment.name, Assignment.outof, Assignment.weight, Assignment.due, Grade.grade).join(Student, Student.sid == Grade.student_id).join(User, User.uid == Student.student_id).filter_by(username = session.get('username')).order_by(Assignment.name).all()
-            average = 0
-            num = 0 
-            mark = 0
-            for grade in grades:   
-                if grade.grade != None:
-                    average += grade.grade/grade.outof*100
-                    num += 1
-                    mark += grade.grade/grade.outof*grade.weight
-            if num > 0:
-                average = average / num
-            sum_info = ( round(average, 2), round(mark, 2))
+            sid = g.principal.sid if g.principal else None
+            grades = student_grades(sid)
+            sum_info = grade_summary(sid) if sid else (0, 0)
             return render_template("grades.html", pagename = "Grades", grades = grades, sum_info = sum_info)
 
         else:
             gradeID = request.form.get('gradeID')
-            grade = Grade.query.filter_by(gid = gradeID).join(Assignment, Assignment.aid == Grade.asmt_id).add_columns(Assignment.name, Assignment.outof, Assignment.weight, Grade.grade).first()
             return redirect(url_for('requestregrade', gid = gradeID))
     
 
+@app.route("/bulk_grades", methods = ["POST"])
+def bulk_grades():
+    if course_role() != "Instructor":
+        return redirect(url_for('grades'))
+
+    if request.files.get('file'):
+        rows = csv.DictReader(io.TextIOWrapper(request.files['file'].stream, encoding = "utf-8"))
+    else:
+        rows = request.get_json(silent = True)
+        if rows is None:
+            rows = []
+        elif isinstance(rows, dict):
+            rows = rows.get('grades', [])
+        if not isinstance(rows, list):
+            abort(400)
+    report = apply_bulk_grades(rows, course_id = g.course_id)
+    applied = sum(1 for result in report if result["status"] == "ok")
+    return jsonify(applied = applied, failed = len(report) - applied, results = report)
+
+
+@app.route("/gradebook")
+def gradebook():
+    if course_role() != "Instructor":
+        return redirect(url_for('grades'))
+
+    asmts = course_query(Assignment).order_by(Assignment.name).all()
+    rows = db.session.execute(gradebook_query(asmts, course_id = g.course_id).execution_options(stream_results = True))
+    if request.args.get('format') == "json":
+        return Response(stream_with_context(gradebook_json(asmts, rows)), mimetype = "application/json")
+    else:
+        headers = {"Content-Disposition": "attachment; filename=gradebook.csv"}
+        return Response(stream_with_context(gradebook_csv(asmts, rows)), mimetype = "text/csv", headers = headers)
+
+
+@app.route("/cache_stats")
+def cache_stats():
+    if course_role() != "Instructor":
+        return redirect(url_for('home'))
+    return jsonify(page_cache.stats() if page_cache else {"backend": None})
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    lines = []
+    for metric in metrics.values():
+        lines.extend(metric.render())
+    if page_cache is not None:
+        stats = page_cache.stats()
+        for name in ("hits", "misses", "invalidations"):
+            lines.append(f"# TYPE app_page_cache_{name}_total counter")
+            lines.append(f"app_page_cache_{name}_total {stats[name]}")
+    return Response("\n".join(lines) + "\n", mimetype = "text/plain; version=0.0.4")
+
+
 @app.route("/login", methods = ["GET", "POST"])
 def login():
     if request.method == "GET":
@@ -422,21 +1439,19 @@ def login():
         uname = request.form['username']
         password = request.form['password']
         user = User.query.filter_by(username = uname).first()
-        if not user or not bcrypt.check_password_hash(user.password, password):
+        try:
+            valid = user is not None and check_password(user.password, password)
+        except PasswordPoolBusy:
+            flash("The server is busy. Please try again in a moment.", 'error')
+            return render_template('login.html', pagename = 'Login'), 503, {"Retry-After": "1"}
+        if not valid:
             flash("Login failed. Please check your details and try again, or register a new account", 'error')
             return render_template('login.html', pagename = 'Login')
         else:
-            student = Student.query.filter_by(student_id = user.uid, course_id = 1).first()
-            teacher = Teacher.query.filter_by(teacher_id = user.uid, course_id = 1).first()
-            if student:
-                session['username'] = user.username
-                session['type'] = "Student"
-                flash("Logged in as Student.", "Notice")
-                return redirect(url_for("home"))
-            elif teacher:
-                session['username'] = user.username
-                session['type'] = "Instructor"
-                flash("Logged in as Instructor.", "Notice")
+            principal = get_principal(user.username, g.course_id)
+            if principal is not None and principal.role is not None:
+                start_session(principal)
+                flash("Logged in as " + principal.role + ".", "Notice")
                 return redirect(url_for("home"))
             else:
                 flash("Login failed. You do not have access to this course", 'error')
@@ -452,8 +1467,12 @@ def register():
         if request.method == "GET":
             return render_template('register.html', pagename = 'Register')
         else:
-            hashed_password = bcrypt.generate_password_hash(request.form["password"]).decode("utf-8")
-            if bcrypt.check_password_hash(hashed_password, request.form["confirmpassword"]):
+            if request.form["password"] == request.form["confirmpassword"]:
+                try:
+                    hashed_password = hash_password(request.form["password"])
+                except PasswordPoolBusy:
+                    flash("The server is busy. Please try again in a moment.", 'error')
+                    return render_template('register.html', pagename = 'Register'), 503, {"Retry-After": "1"}
                 fname = request.form['firstname']
                 lname = request.form['lastname']
                 uname = request.form['username']
@@ -463,12 +1482,13 @@ def register():
                     fname, lname, uname, email, type, hashed_password
                 )
                 try:
-                    add_user(new_user)
-                    session['username'] = uname
-                    session['type'] = type
+                    add_user(new_user, course_id = g.course_id)
+                    forget_principal(uname)
+                    start_session(get_principal(uname, g.course_id))
                     flash("Registered as " + type, "Notice")
                     return redirect(url_for('home'))
                 except SQLAlchemyError as e:
+                    db.session.rollback()
                     flash("Account exists already. Log in instead or use a different username/email.", "error")
                     return render_template("register.html", pagename = 'Register')
                 
@@ -477,41 +1497,988 @@ def register():
                 return render_template('register.html', pagename = 'Register')
 
 
+add_course_routes(exclude = ("static", "metrics_endpoint", "cache_stats"))
+
+
 # HELPER FUNCTIONS
-def add_user(new_user):
+def add_user(new_user, course_id):
     user = User(firstname = new_user[0], lastname = new_user[1], username = new_user[2], email = new_user[3], password = new_user[5])
     db.session.add(user)
-    db.session.commit()
+    db.session.flush()
     if new_user[4] == "Student":
-        for user in db.session.query(User).filter(User.username == new_user[2]):
-            student = Student(course_id = 1, student_id = user.uid)
-            db.session.add(student)
-            db.session.commit()
-
-            tasks = Assignment.query.filter_by(course_id = 1).all()
-            student_db = Student.query.filter_by(student_id = user.uid).first()
-            for task in tasks:
-                grade = Grade(student_id = student_db.sid, asmt_id = task.aid)
-                db.session.add(grade)
-                db.session.commit()
+        student = Student(course_id = course_id, student_id = user.uid)
+        db.session.add(student)
+        db.session.flush()
+        assigned = fan_out_student_grades(student.sid, course_id = course_id)
+        db.session.add(GradeSummary(student_id = student.sid, assigned = assigned))
     else:
-        for user in db.session.query(User).filter(User.username == new_user[2]):
-            instructor = Teacher(course_id = 1, teacher_id = user.uid)
-            db.session.add(instructor)
-            db.session.commit()
+        instructor = Teacher(course_id = course_id, teacher_id = user.uid)
+        db.session.add(instructor)
+    db.session.commit()
 
 
-def add_asmt_db(new_asmt):
-    asmt = Assignment(name = new_asmt[0], due = new_asmt[1], outof = new_asmt[2], weight = new_asmt[3], course_id = 1)
+def add_asmt_db(new_asmt, course_id):
+    asmt = Assignment(name = new_asmt[0], due = new_asmt[1], outof = new_asmt[2], weight = new_asmt[3], course_id = course_id)
     db.session.add(asmt)
+    db.session.flush()
+    fan_out_asmt_grades(asmt.aid, course_id = course_id)
+    # new grades start empty, so only the assigned count moves
+    students = select(Student.sid).where(Student.course_id == course_id)
+    db.session.execute(update(GradeSummary).where(GradeSummary.student_id.in_(students)).values(assigned = GradeSummary.assigned + 1).execution_options(synchronize_session = False))
     db.session.commit()
+    invalidate_pages("assignments", course_id = course_id)
+    return asmt
+
 
-    students = Student.query.filter_by(course_id = 1).all()
-    asmt_db = Assignment.query.filter_by(name = new_asmt[0]).first()
-    for student in students:
-        grade = Grade(student_id = student.sid, asmt_id = asmt_db.aid)
-        db.session.add(grade)
+# LIST VIEWS
+# List pages read plain column rows rather than ORM entities: nothing enters
+# the identity map, nothing can lazy load from a template, and every list is
+# fetched with .all() so a template iterating it never re-runs the query.
+def course_students_query(course_id):
+    return db.session.query(Student.sid, User.firstname, User.lastname).join(User, User.uid == Student.student_id).filter(Student.course_id == course_id).order_by(User.lastname)
+
+
+def course_students(course_id):
+    return course_students_query(course_id).all()
+
+
+def course_instructors(course_id):
+    return db.session.query(Teacher.tid, User.firstname, User.lastname).join(User, User.uid == Teacher.teacher_id).filter(Teacher.course_id == course_id).order_by(User.firstname).all()
+
+
+def student_grades_query(sid):
+    return db.session.query(Assignment.aid, Assignment.name, Assignment.outof, Assignment.weight, Assignment.due, Grade.gid, Grade.grade).join(Assignment, Assignment.aid == Grade.asmt_id).filter(Grade.student_id == sid).order_by(Assignment.name)
+
+
+def student_grades(sid):
+    return student_grades_query(sid).all()
+
+
+def grade_student_query(gid, course_id):
+    return db.session.query(Student.sid, User.firstname, User.lastname).select_from(Grade).join(Student, Student.sid == Grade.student_id).join(User, User.uid == Student.student_id).filter(Grade.gid == gid, Student.course_id == course_id)
+
+
+def grade_student(gid, course_id):
+    return grade_student_query(gid, course_id).first()
+
+
+def open_regrades_query(sid):
+    return db.session.query(Regrade.grade_id, func.count(Regrade.rid).label("count")).join(Grade, Grade.gid == Regrade.grade_id).filter(Grade.student_id == sid, Regrade.resolved == 0).group_by(Regrade.grade_id)
+
+
+def open_regrades_by_grade(sid):
+    return open_regrades_query(sid).all()
+
+
+def teacher_feedback_query(tid):
+    return db.session.query(Feedback.fid, Feedback.feedback, Feedback.category, Feedback.anonymous, User.username).join(Student, Feedback.student_id == Student.sid).join(User, User.uid == Student.student_id).filter(Feedback.teacher_id == tid).order_by(Feedback.fid)
+
+
+def teacher_feedback(tid):
+    return teacher_feedback_query(tid).all()
+
+
+# BULK GRADE FAN-OUT
+# Placeholder Grade rows are created with a single INSERT ... SELECT so the
+# database does the fan-out; callers own the transaction and commit once.
+def asmt_grade_rows(aid, course_id):
+    return select(Student.sid, literal(aid)).where(Student.course_id == course_id)
+
+
+def fan_out_asmt_grades(aid, course_id):
+    rows = asmt_grade_rows(aid, course_id)
+    return db.session.execute(insert(Grade).from_select(["student_id", "asmt_id"], rows)).rowcount
+
+
+def fan_out_student_grades(sid, course_id):
+    rows = select(literal(sid), Assignment.aid).where(Assignment.course_id == course_id)
+    return db.session.execute(insert(Grade).from_select(["student_id", "asmt_id"], rows)).rowcount
+
+
+def enroll_students(user_ids, course_id):
+    # Students are inserted with one executemany, then every new student gets a
+    # Grade row for every existing assignment in one INSERT ... SELECT. The new
+    # rows are picked out by user id, so user_ids must not already be enrolled.
+    user_ids = list(user_ids)
+    db.session.execute(insert(Student), [{"course_id": course_id, "student_id": uid} for uid in user_ids])
+    enrolled = (Student.course_id == course_id) & Student.student_id.in_(user_ids)
+    rows = select(Student.sid, Assignment.aid).join(Assignment, Assignment.course_id == Student.course_id).where(enrolled)
+    added = db.session.execute(insert(Grade).from_select(["student_id", "asmt_id"], rows)).rowcount
+    assigned = select(func.count(Assignment.aid)).where(Assignment.course_id == course_id).scalar_subquery()
+    summaries = select(Student.sid, assigned).where(enrolled)
+    db.session.execute(insert(GradeSummary).from_select(["student_id", "assigned"], summaries))
+    return added
+
+
+# GRADEBOOK EXPORT
+# The whole class is computed by one GROUP BY over Student x Grade, pivoting
+# each assignment into its own column, and streamed out row by row.
+def gradebook_query(asmts, course_id):
+    s_user = aliased(User)
+    regrades = select(Grade.student_id, func.count(Regrade.rid).label("open")).join(Regrade, Regrade.grade_id == Grade.gid).join(Student, Student.sid == Grade.student_id).where(Regrade.resolved == 0, Student.course_id == course_id).group_by(Grade.student_id).subquery()
+    pivot = [func.max(case((Grade.asmt_id == asmt.aid, Grade.grade))).label(f"a{asmt.aid}") for asmt in asmts]
+    average = func.avg(Grade.grade * 100.0 / Assignment.outof)
+    mark = func.coalesce(func.sum(Grade.grade * 1.0 / Assignment.outof * Assignment.weight), 0)
+    return select(Student.sid, s_user.firstname, s_user.lastname, *pivot, func.coalesce(func.max(regrades.c.open), 0).label("regrades"), func.coalesce(average, 0).label("average"), mark.label("mark")).select_from(Student).join(s_user, s_user.uid == Student.student_id).outerjoin(Grade, Grade.student_id == Student.sid).outerjoin(Assignment, Assignment.aid == Grade.asmt_id).outerjoin(regrades, regrades.c.student_id == Student.sid).where(Student.course_id == course_id).group_by(Student.sid, s_user.firstname, s_user.lastname).order_by(s_user.lastname, Student.sid)
+
+
+def gradebook_record(asmts, row):
+    return {
+        "sid": row.sid,
+        "firstname": row.firstname,
+        "lastname": row.lastname,
+        "grades": {asmt.name: row._mapping[f"a{asmt.aid}"] for asmt in asmts},
+        "regrades": row.regrades,
+        "average": round(row.average, 2),
+        "mark": round(row.mark, 2),
+    }
+
+
+def gradebook_csv(asmts, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["sid", "firstname", "lastname"] + [asmt.name for asmt in asmts] + ["regrades", "average", "mark"])
+    for row in rows:
+        record = gradebook_record(asmts, row)
+        writer.writerow([record["sid"], record["firstname"], record["lastname"]] + list(record["grades"].values()) + [record["regrades"], record["average"], record["mark"]])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def gradebook_json(asmts, rows):
+    yield "["
+    separator = ""
+    for row in rows:
+        yield separator + json.dumps(gradebook_record(asmts, row))
+        separator = ","
+    yield "]"
+
+
+# DAILY SMILE FEED
+# The feed is paged by keyset on (date_posted, hid), newest first. The newest
+# smile is remembered per process so conditional GETs can be answered with a
+# 304 before any query runs; SMILE_FEED_TTL bounds how stale another
+# process's view of it can be.
+smile_feed = TTLCache(1, app.config['SMILE_FEED_TTL'])
+
+
+def latest_smile():
+    newest = smile_feed.get("latest")
+    if newest is None:
+        newest = db.session.query(Smile.hid, Smile.date_posted).order_by(Smile.date_posted.desc(), Smile.hid.desc()).first()
+        newest = tuple(newest) if newest else ()
+        smile_feed.set("latest", newest)
+    return newest
+
+
+def smile_cursor(smile):
+    return f"{smile.date_posted.isoformat()}~{smile.hid}"
+
+
+def parse_smile_cursor(cursor):
+    try:
+        date_posted, hid = cursor.split("~")
+        return datetime.fromisoformat(date_posted), int(hid)
+    except ValueError:
+        return None
+
+
+def smile_page_query(after = None):
+    smiles = db.session.query(User.firstname, User.lastname, Smile.title, Smile.link, Smile.type, Smile.desc, Smile.posted_by, Smile.date_posted, Smile.hid).select_from(Smile).join(Teacher, Teacher.tid == Smile.posted_by).join(User, User.uid == Teacher.teacher_id)
+    if after:
+        smiles = smiles.filter(tuple_(Smile.date_posted, Smile.hid) < after)
+    return smiles.order_by(Smile.date_posted.desc(), Smile.hid.desc())
+
+
+def smile_page(after = None):
+    # returns up to SMILE_PAGE_SIZE + 1 smiles posted before the cursor
+    return smile_page_query(after).limit(SMILE_PAGE_SIZE + 1).all()
+
+
+def smile_record(smile):
+    return {
+        "hid": smile.hid,
+        "title": smile.title,
+        "link": smile.link,
+        "type": smile.type,
+        "desc": smile.desc,
+        "date_posted": smile.date_posted.isoformat(),
+        "posted_by": smile.posted_by,
+        "firstname": smile.firstname,
+        "lastname": smile.lastname,
+    }
+
+
+def smile_feed_response(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = "private, no-cache"
+    response.vary.add("Cookie")
+    return response
+
+
+# REGRADE QUEUE
+# Instructors see the regrades of the current course when they teach it, as
+# given by their principal, so the queue query never joins through Teacher
+# (which duplicated rows when a course had several instructors). Open counts
+# per assignment come from RegradeCount instead of counting Regrade rows.
+def regrade_queue_query(courses, status = None):
+    # driven from Regrade through ix_regrade_resolved_grade and joined outward
+    # by primary key, so the cost follows the number of regrades rather than
+    # the course's grades; the resolved IN (...) filter is what lets the
+    # planner start from Regrade when no status is chosen
+    resolved = {"open": (0,), "resolved": (1,)}.get(status, (0, 1))
+    s_user = aliased(User)
+    return db.session.query(Regrade.rid, Grade.gid, Regrade.resolved, Student.sid,  s_user.firstname.label("SFirst"), s_user.lastname.label("SLast"), Assignment.name, Assignment.outof, Grade.grade, Assignment.weight, Regrade.reason).select_from(Regrade).join(Grade, Grade.gid == Regrade.grade_id).join(Student, Student.sid == Grade.student_id).join(Assignment, Assignment.aid == Grade.asmt_id).join(s_user, s_user.uid == Student.student_id).filter(Regrade.resolved.in_(resolved), Assignment.course_id.in_(courses)).order_by(Regrade.resolved, Assignment.name, Regrade.rid)
+
+
+def regrade_queue(courses, status = None, page = 1):
+    # open requests first; returns up to REGRADE_PAGE_SIZE + 1 rows so callers can tell if there is a next page
+    return regrade_queue_query(courses, status).limit(REGRADE_PAGE_SIZE + 1).offset((max(page, 1) - 1) * REGRADE_PAGE_SIZE).all()
+
+
+def regrade_record(regrade):
+    return {
+        "rid": regrade.rid,
+        "gid": regrade.gid,
+        "resolved": bool(regrade.resolved),
+        "sid": regrade.sid,
+        "firstname": regrade.SFirst,
+        "lastname": regrade.SLast,
+        "assignment": regrade.name,
+        "grade": regrade.grade,
+        "outof": regrade.outof,
+        "weight": regrade.weight,
+        "reason": regrade.reason,
+    }
+
+
+def count_open_regrades(asmt_ids):
+    rows = db.session.query(Grade.asmt_id, func.count(Regrade.rid)).join(Regrade, Regrade.grade_id == Grade.gid).filter(Grade.asmt_id.in_(asmt_ids)).filter(Regrade.resolved == 0).group_by(Grade.asmt_id)
+    counts = dict.fromkeys(asmt_ids, 0)
+    counts.update(rows)
+    return counts
+
+
+def regrade_counts_query(courses):
+    return db.session.query(Assignment.aid, Assignment.name, RegradeCount.open).outerjoin(RegradeCount, RegradeCount.asmt_id == Assignment.aid).filter(Assignment.course_id.in_(courses)).order_by(Assignment.name)
+
+
+def regrade_counts(courses):
+    # {assignment name: open regrades}; counters missing from an older database are filled in
+    asmts = regrade_counts_query(courses).all()
+    missing = [asmt.aid for asmt in asmts if asmt.open is None]
+    if missing:
+        filled = count_open_regrades(missing)
+        db.session.execute(insert_missing(RegradeCount), [{"asmt_id": aid, "open": count} for aid, count in filled.items()])
         db.session.commit()
+    return {asmt.name: asmt.open if asmt.open is not None else filled[asmt.aid] for asmt in asmts}
+
+
+def update_regrade_count(gid, delta):
+    # call after the Regrade change is flushed, before committing
+    asmt_id = db.session.query(Grade.asmt_id).filter(Grade.gid == gid).scalar()
+    db.session.flush()
+    changed = db.session.execute(update(RegradeCount).where(RegradeCount.asmt_id == asmt_id).values(open = RegradeCount.open + delta)).rowcount
+    if not changed:
+        db.session.add(RegradeCount(asmt_id = asmt_id, open = count_open_regrades([asmt_id])[asmt_id]))
+
+
+def rebuild_regrade_counts():
+    RegradeCount.__table__.create(db.engine, checkfirst = True)
+    db.session.execute(delete(RegradeCount))
+    asmt_ids = [aid for (aid,) in db.session.query(Assignment.aid)]
+    if asmt_ids:
+        db.session.execute(insert(RegradeCount), [{"asmt_id": aid, "open": count} for aid, count in count_open_regrades(asmt_ids).items()])
+    db.session.commit()
+    return len(asmt_ids)
+
+
+# GRADING STATUS
+# A scheduler job counts the empty grades of every assignment with one
+# aggregate over Grade, answered from the ix_grade_asmt_grade index, and
+# replaces grading_statuses with the result. Routes read the counts from
+# there and never query for them. When a course's counts change, its pages
+# tagged "grading" are invalidated.
+AssignmentStatus = namedtuple("AssignmentStatus", ["aid", "due", "assigned", "ungraded", "overdue"])
+
+grading_statuses = {} # course_id -> {aid: AssignmentStatus}, replaced as a whole
+
+
+def grading_status_query():
+    return db.session.query(Assignment.course_id, Assignment.aid, Assignment.due, func.count(Grade.gid), func.count(Grade.gid) - func.count(Grade.grade)).outerjoin(Grade, Grade.asmt_id == Assignment.aid).group_by(Assignment.aid)
+
+
+@scheduler.every(app.config['GRADING_STATUS_INTERVAL'])
+def refresh_grading_status(now = None):
+    global grading_statuses
+    now = now or datetime.now()
+    statuses = {}
+    for course_id, aid, due, assigned, ungraded in grading_status_query():
+        statuses.setdefault(course_id, {})[aid] = AssignmentStatus(aid, due, assigned, ungraded, ungraded if due is not None and due < now else 0)
+    changed = [course_id for course_id in statuses.keys() | grading_statuses.keys() if statuses.get(course_id) != grading_statuses.get(course_id)]
+    grading_statuses = statuses
+    for course_id in changed:
+        invalidate_pages("grading", course_id = course_id)
+    return statuses
+
+
+def grading_status(course_id):
+    return grading_statuses.get(course_id, {})
+
+
+def grading_status_record(status):
+    return {
+        "aid": status.aid,
+        "due": status.due.isoformat() if status.due else None,
+        "assigned": status.assigned,
+        "ungraded": status.ungraded,
+        "overdue": status.overdue,
+    }
+
+
+# GRADE SUMMARIES
+# GradeSummary keeps per-student running sums so the grades page reads one row
+# instead of rescanning every Grade. Rows missing from an older database are
+# filled in on first use.
+def summarize_grades(grades):
+    average = 0
+    num = 0
+    mark = 0
+    for grade in grades:
+        if grade.grade != None:
+            average += grade.grade/grade.outof*100
+            num += 1
+            mark += grade.grade/grade.outof*grade.weight
+    if num > 0:
+        average = average / num
+    return ( round(average, 2), round(mark, 2))
+
+
+def summary_rows(sid = None):
+    # one aggregate over Grade x Assignment, per student
+    rows = select(Student.sid, func.count(Grade.gid), func.count(Grade.grade), func.coalesce(func.sum(Grade.grade * 100.0 / Assignment.outof), 0), func.coalesce(func.sum(Grade.grade * 1.0 / Assignment.outof * Assignment.weight), 0)).select_from(Student).outerjoin(Grade, Grade.student_id == Student.sid).outerjoin(Assignment, Assignment.aid == Grade.asmt_id).group_by(Student.sid)
+    if sid is not None:
+        rows = rows.where(Student.sid == sid)
+    return rows
+
+
+def create_grade_summary(sid):
+    # built from the grades; two requests that both find the row missing may
+    # both get here, and the later insert is skipped
+    db.session.execute(insert_missing(GradeSummary).from_select(["student_id", "assigned", "graded", "pct_sum", "mark_sum"], summary_rows(sid)))
+    return GradeSummary.query.get(sid)
+
+
+def load_grade_summary(sid):
+    return GradeSummary.query.get(sid) or create_grade_summary(sid)
+
+
+def grade_summary(sid):
+    summary = GradeSummary.query.get(sid)
+    if summary is None:
+        summary = create_grade_summary(sid)
+        db.session.commit()
+    if summary is None:
+        return (0, 0)
+    return summary.sum_info()
+
+
+def change_grade(grade, newgrade):
+    # the grade is written with a compare-and-set on the value it replaces, so
+    # when two edits of one grade race, each moves the summary by exactly what
+    # it replaced; the loser re-reads the grade and tries again
+    grades = Grade.__table__
+    while grade.grade != newgrade:
+        oldgrade = grade.grade
+        replaces = grades.c.grade.is_(None) if oldgrade is None else grades.c.grade == oldgrade
+        if db.session.execute(update(grades).where(grades.c.gid == grade.gid, replaces).values(grade = newgrade)).rowcount:
+            update_grade_summary(grade, oldgrade, newgrade)
+            set_committed_value(grade, "grade", newgrade)
+            break
+        db.session.refresh(grade, ["grade"])
+
+
+def update_grade_summary(grade, oldgrade, newgrade):
+    # apply the difference between the old and new grade to the running sums;
+    # call after the Grade row holds newgrade. The sums are added to in SQL, so
+    # two edits for the same student at once both count.
+    asmt = Assignment.query.get(grade.asmt_id)
+    graded, pct, mark = summary_delta(oldgrade, newgrade, asmt.outof, asmt.weight)
+    summaries = GradeSummary.__table__
+    change = update(summaries).where(summaries.c.student_id == grade.student_id).values(graded = summaries.c.graded + graded, pct_sum = summaries.c.pct_sum + pct, mark_sum = summaries.c.mark_sum + mark)
+    if not db.session.execute(change).rowcount:
+        # no row yet: built from the grades, which already include newgrade
+        load_grade_summary(grade.student_id)
+
+
+def summary_delta(oldgrade, newgrade, outof, weight):
+    # (graded, pct_sum, mark_sum) change when a grade goes from oldgrade to newgrade
+    graded = pct = mark = 0
+    if oldgrade != None:
+        graded -= 1
+        pct -= oldgrade/outof*100
+        mark -= oldgrade/outof*weight
+    if newgrade != None:
+        graded += 1
+        pct += newgrade/outof*100
+        mark += newgrade/outof*weight
+    return graded, pct, mark
+
+
+
+def rebuild_grade_summaries():
+    GradeSummary.__table__.create(db.engine, checkfirst = True)
+    db.session.execute(delete(GradeSummary))
+    db.session.execute(insert(GradeSummary).from_select(["student_id", "assigned", "graded", "pct_sum", "mark_sum"], summary_rows()))
+    db.session.commit()
+    return GradeSummary.query.count()
+
+
+def rebuild_student_summaries(sids):
+    # recomputed from the grades as this transaction sees them; callers commit
+    sids = list(sids)
+    db.session.execute(delete(GradeSummary).where(GradeSummary.student_id.in_(sids)))
+    db.session.execute(insert(GradeSummary).from_select(["student_id", "assigned", "graded", "pct_sum", "mark_sum"], summary_rows().where(Student.sid.in_(sids))))
+
+
+def check_grade_summaries():
+    # compare stored summaries with the on-the-fly calculation; returns the
+    # (sid, stored, computed) triples that disagree
+    GradeSummary.__table__.create(db.engine, checkfirst = True)
+    mismatches = []
+    grades = db.session.query(Grade.student_id, Assignment.outof, Assignment.weight, Grade.grade).join(Assignment, Assignment.aid == Grade.asmt_id).order_by(Grade.student_id)
+    by_student = {sid: summarize_grades(rows) for sid, rows in groupby(grades, key = lambda row: row.student_id)}
+    stored = {summary.student_id: summary.sum_info() for summary in GradeSummary.query}
+    for sid, in db.session.query(Student.sid):
+        computed = by_student.get(sid, (0, 0))
+        if stored.get(sid) != computed:
+            mismatches.append((sid, stored.get(sid), computed))
+    return mismatches
+
+
+# BULK GRADE ENTRY
+# A batch of (sid, aid, grade) rows is validated in one pass against the
+# course's assignments and existing Grade rows, then written with one
+# executemany in a single transaction. The touched students' summaries are
+# rebuilt from their grades inside that transaction, so an edit_grade landing
+# between the validation read and the write cannot leave them wrong.
+def bulk_grade_ids(row):
+    # (sid, aid) as integers, or None if either is missing or not a whole number;
+    # JSON may send 7.0 and CSV " 7" or "+7", which all mean 7
+    try:
+        ids = tuple(row[key] for key in ("sid", "aid"))
+        if any(isinstance(value, bool) or isinstance(value, float) and not value.is_integer() for value in ids):
+            return None
+        return tuple(int(value) for value in ids)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def parse_bulk_grade(row, ids, asmts, grades):
+    if ids is None:
+        raise ValueError("sid and aid must be integers")
+    sid, aid = ids
+    if aid not in asmts:
+        raise ValueError(f"assignment {aid} is not in this course")
+    if (sid, aid) not in grades:
+        raise ValueError(f"student {sid} has no grade for assignment {aid}")
+    value = row.get("grade")
+    if value is None or str(value).strip() == "":
+        return sid, aid, None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("grade must be a number")
+    if not 0 <= value <= asmts[aid].outof:
+        raise ValueError(f"grade must be between 0 and {asmts[aid].outof}")
+    return sid, aid, value
+
+
+def apply_bulk_grades(rows, course_id):
+    rows = list(rows)
+    asmts = {asmt.aid: asmt for asmt in db.session.query(Assignment.aid, Assignment.outof).filter(Assignment.course_id == course_id)}
+    ids = [bulk_grade_ids(row) if isinstance(row, dict) else None for row in rows]
+    aids = {key[1] for key in ids if key is not None} & set(asmts)
+    grades = {(grade.student_id, grade.asmt_id): grade.gid for grade in db.session.query(Grade.gid, Grade.student_id, Grade.asmt_id).filter(Grade.asmt_id.in_(aids))}
+
+    report = []
+    changes = []
+    for number, (row, key) in enumerate(zip(rows, ids), start = 1):
+        try:
+            if not isinstance(row, dict):
+                raise ValueError("row must have sid, aid and grade")
+            sid, aid, value = parse_bulk_grade(row, key, asmts, grades)
+        except ValueError as e:
+            report.append({"row": number, "status": "error", "message": str(e)})
+            continue
+        changes.append({"b_gid": grades[(sid, aid)], "b_grade": value})
+        report.append({"row": number, "status": "ok", "sid": sid, "aid": aid, "grade": value})
+
+    if changes:
+        db.session.execute(update(Grade.__table__).where(Grade.__table__.c.gid == bindparam("b_gid")).values(grade = bindparam("b_grade")), changes)
+        rebuild_student_summaries({result["sid"] for result in report if result["status"] == "ok"})
+        db.session.commit()
+    return report
+
+
+# ROSTER IMPORT
+# Registrar exports are streamed a row at a time and written IMPORT_CHUNK_SIZE
+# rows per transaction: one executemany for new users, enroll_students for the
+# Student rows and their grade matrix, one executemany for marks and a summary
+# rebuild for the students that got marks. Any column named after one of the
+# course's assignments is a mark. Passwords are hashed in a process pool, and
+# rows without one get an unusable password. After every chunk the number of
+# the last committed row goes to a checkpoint file, so a failed import is
+# rerun from there; re-importing a row only repeats its marks.
+ROSTER_FIELDS = ("username", "firstname", "lastname", "email")
+UNUSABLE_PASSWORD = "!"
+
+class CheckpointMismatch(Exception):
+    pass
+
+
+ImportProgress = namedtuple("ImportProgress", ["row", "users", "students", "marks", "errors"])
+
+
+def read_roster(path, start = 0):
+    with open(path, newline = "", encoding = "utf-8-sig") as f:
+        for number, row in enumerate(csv.DictReader(f), start = 1):
+            if number > start:
+                yield number, row
+
+
+def batches(rows, size):
+    rows = iter(rows)
+    batch = list(islice(rows, size))
+    while batch:
+        yield batch
+        batch = list(islice(rows, size))
+
+
+def parse_roster_row(row, asmts):
+    user = {}
+    for field in ROSTER_FIELDS:
+        value = (row.get(field) or "").strip()
+        if not value:
+            raise ValueError(f"{field} is missing")
+        user[field] = value
+    marks = {}
+    for name, (aid, outof) in asmts.items():
+        value = (row.get(name) or "").strip()
+        if not value:
+            continue
+        try:
+            mark = float(value)
+        except ValueError:
+            raise ValueError(f"{name}: grade must be a number")
+        if not 0 <= mark <= outof:
+            raise ValueError(f"{name}: grade must be between 0 and {outof}")
+        marks[aid] = mark
+    return user, (row.get("password") or "").strip(), marks
+
+
+def hash_passwords(passwords, pool = None):
+    rounds = app.config['BCRYPT_LOG_ROUNDS']
+    jobs = [password for password in passwords if password]
+    if pool is None:
+        hashes = iter([hash_password_job(password, rounds) for password in jobs])
+    else:
+        hashes = pool.map(hash_password_job, jobs, repeat(rounds), chunksize = 16)
+    return [next(hashes) if password else UNUSABLE_PASSWORD for password in passwords]
+
+
+def import_roster_chunk(batch, asmts, course_id, pool = None):
+    errors = []
+    parsed = {}
+    for number, row in batch:
+        try:
+            parsed_row = parse_roster_row(row, asmts)
+        except ValueError as e:
+            errors.append((number, str(e)))
+            continue
+        # a later row for the same username wins
+        parsed[parsed_row[0]["username"]] = (number,) + parsed_row
+
+    uids = dict(db.session.query(User.username, User.uid).filter(User.username.in_(list(parsed))))
+    emails = dict(db.session.query(User.email, User.username).filter(User.email.in_([user["email"] for number, user, password, marks in parsed.values()])))
+    new_users = []
+    for username, (number, user, password, marks) in list(parsed.items()):
+        if emails.setdefault(user["email"], username) != username:
+            errors.append((number, f"email {user['email']} belongs to {emails[user['email']]}"))
+            del parsed[username]
+        elif username not in uids:
+            new_users.append((user, password))
+
+    if new_users:
+        hashes = hash_passwords([password for user, password in new_users], pool)
+        db.session.execute(insert(User), [dict(user, password = pw_hash) for (user, password), pw_hash in zip(new_users, hashes)])
+        uids.update(db.session.query(User.username, User.uid).filter(User.username.in_([user["username"] for user, password in new_users])))
+
+    chunk_uids = [uids[username] for username in parsed]
+    enrolled = dict(db.session.query(Student.student_id, Student.sid).filter(Student.course_id == course_id, Student.student_id.in_(chunk_uids)))
+    to_enroll = [uid for uid in chunk_uids if uid not in enrolled]
+    if to_enroll:
+        enroll_students(to_enroll, course_id = course_id)
+        enrolled.update(db.session.query(Student.student_id, Student.sid).filter(Student.course_id == course_id, Student.student_id.in_(to_enroll)))
+
+    changes = [{"b_sid": enrolled[uids[username]], "b_aid": aid, "b_grade": mark} for username, (number, user, password, marks) in parsed.items() for aid, mark in marks.items()]
+    if changes:
+        grades = Grade.__table__
+        db.session.execute(update(grades).where(grades.c.student_id == bindparam("b_sid"), grades.c.asmt_id == bindparam("b_aid")).values(grade = bindparam("b_grade")), changes)
+        rebuild_student_summaries({change["b_sid"] for change in changes})
+    db.session.commit()
+    return ImportProgress(batch[-1][0], len(new_users), len(to_enroll), len(changes), errors)
+
+
+def read_checkpoint(checkpoint, path):
+    try:
+        with open(checkpoint) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return 0
+    if state.get("source") != os.path.abspath(path) or state.get("size") != os.path.getsize(path):
+        raise CheckpointMismatch(f"{checkpoint} was written for a different file")
+    return state["row"]
+
+
+def write_checkpoint(checkpoint, path, row):
+    # write then rename, so a crash never leaves half a checkpoint
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(checkpoint)))
+    with os.fdopen(fd, "w") as f:
+        json.dump({"source": os.path.abspath(path), "size": os.path.getsize(path), "row": row}, f)
+    os.replace(tmp, checkpoint)
+
+
+def import_roster(path, course_id, checkpoint = None, chunk_size = None, restart = False):
+    checkpoint = checkpoint or path + ".checkpoint"
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    start = read_checkpoint(checkpoint, path)
+    asmts = {asmt.name: (asmt.aid, asmt.outof) for asmt in db.session.query(Assignment.aid, Assignment.name, Assignment.outof).filter(Assignment.course_id == course_id)}
+    workers = app.config['BCRYPT_WORKERS']
+    pool = ProcessPoolExecutor(max_workers = workers) if workers > 0 else None
+    try:
+        for batch in batches(read_roster(path, start), chunk_size or app.config['IMPORT_CHUNK_SIZE']):
+            progress = import_roster_chunk(batch, asmts, course_id, pool)
+            write_checkpoint(checkpoint, path, progress.row)
+            yield progress
+    except BaseException:
+        db.session.rollback()
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+# FEEDBACK SUBMISSION
+# A submission, including "all" instructors, is written as one
+# INSERT ... SELECT over Teacher. Repeats of the same submission inside
+# FEEDBACK_DEDUPE_TTL are dropped, keyed by the form's idempotency_key or by
+# the content itself. With FEEDBACK_ASYNC the write is queued to a background
+# thread and the request returns straight away.
+FeedbackSubmission = namedtuple("FeedbackSubmission", ["sid", "instructor", "category", "anonymous", "feedback", "course_id"])
+
+recent_feedback = TTLCache(app.config['FEEDBACK_QUEUE_SIZE'], app.config['FEEDBACK_DEDUPE_TTL'])
+
+
+def feedback_key(submission, idempotency_key = None):
+    if idempotency_key:
+        return f"{submission.sid}:{idempotency_key}"
+    return hashlib.sha1(json.dumps(submission).encode("utf-8")).hexdigest()
+
+
+def write_feedback(submission):
+    recipients = select(Teacher.tid, literal(submission.sid), literal(submission.category), literal(submission.anonymous), literal(submission.feedback)).where(Teacher.course_id == submission.course_id)
+    if submission.instructor != "all":
+        recipients = recipients.where(Teacher.tid == int(submission.instructor))
+    count = db.session.execute(insert(Feedback).from_select(["teacher_id", "student_id", "category", "anonymous", "feedback"], recipients)).rowcount
+    db.session.commit()
+    return count
+
+
+class FeedbackWriter:
+    def __init__(self, maxsize):
+        self.jobs = queue.Queue(maxsize)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.run, name = "feedback-writer", daemon = True)
+                self.thread.start()
+
+    def submit(self, submission, key):
+        # returns False when the queue is full so the caller can write inline
+        self.start()
+        try:
+            self.jobs.put_nowait((submission, key))
+            return True
+        except queue.Full:
+            return False
+
+    def run(self):
+        with app.app_context():
+            while True:
+                job = self.jobs.get()
+                try:
+                    if job is not None:
+                        write_feedback(job[0])
+                except Exception:
+                    # one bad submission must not stop the writer; forgetting
+                    # its key lets the student send it again
+                    db.session.rollback()
+                    recent_feedback.delete(job[1])
+                    app.logger.exception("Could not save feedback from student %s", job[0].sid)
+                finally:
+                    self.jobs.task_done()
+                if job is None:
+                    break
+
+    def stop(self):
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+
+feedback_writer = FeedbackWriter(app.config['FEEDBACK_QUEUE_SIZE'])
+atexit.register(feedback_writer.stop)
+
+
+def submit_feedback(submission, idempotency_key = None):
+    # returns False for a duplicate submission; the key is forgotten again if
+    # the write fails, so a retry is not taken for a duplicate
+    key = feedback_key(submission, idempotency_key)
+    if not recent_feedback.add(key, True):
+        return False
+    if not (app.config['FEEDBACK_ASYNC'] and feedback_writer.submit(submission, key)):
+        try:
+            write_feedback(submission)
+        except Exception:
+            recent_feedback.delete(key)
+            raise
+    return True
+
+
+# FEEDBACK SEARCH
+# FeedbackSearch is an external-content FTS5 index over Feedback.category and
+# Feedback.feedback, kept in sync by triggers. It is SQLite only; other
+# databases fall back to LIKE.
+feedback_fts = table("FeedbackSearch", column("rowid"), column("FeedbackSearch"))
+
+FEEDBACK_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS FeedbackSearch USING fts5(category, feedback, content = 'Feedback', content_rowid = 'fid', tokenize = 'porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS feedback_search_insert AFTER INSERT ON Feedback BEGIN INSERT INTO FeedbackSearch(rowid, category, feedback) VALUES (new.fid, new.category, new.feedback); END",
+    "CREATE TRIGGER IF NOT EXISTS feedback_search_delete AFTER DELETE ON Feedback BEGIN INSERT INTO FeedbackSearch(FeedbackSearch, rowid, category, feedback) VALUES ('delete', old.fid, old.category, old.feedback); END",
+    "CREATE TRIGGER IF NOT EXISTS feedback_search_update AFTER UPDATE ON Feedback BEGIN INSERT INTO FeedbackSearch(FeedbackSearch, rowid, category, feedback) VALUES ('delete', old.fid, old.category, old.feedback); INSERT INTO FeedbackSearch(rowid, category, feedback) VALUES (new.fid, new.category, new.feedback); END",
+]
+
+
+def feedback_search_enabled():
+    return db.engine.dialect.name == "sqlite"
+
+
+def create_feedback_search():
+    # creates the index and triggers if missing; a new index is backfilled
+    if not feedback_search_enabled():
+        return False
+    with db.engine.begin() as conn:
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'FeedbackSearch'")).first()
+        for ddl in FEEDBACK_SEARCH_DDL:
+            conn.execute(text(ddl))
+        if not exists:
+            conn.execute(text("INSERT INTO FeedbackSearch(FeedbackSearch) VALUES ('rebuild')"))
+    return not exists
+
+
+def rebuild_feedback_search():
+    create_feedback_search()
+    with db.engine.begin() as conn:
+        conn.execute(text("INSERT INTO FeedbackSearch(FeedbackSearch) VALUES ('rebuild')"))
+        conn.execute(text("INSERT INTO FeedbackSearch(FeedbackSearch) VALUES ('optimize')"))
+    return Feedback.query.count()
+
+
+def fts_terms(search):
+    # every word becomes a quoted term so user input cannot inject FTS5 query
+    # syntax; the porter tokenizer lets "grade" match "grading" and "graded"
+    return " ".join('"' + word.replace('"', '""') + '"' for word in search.split())
+
+
+def search_feedback_query(tid, search):
+    feedback = db.session.query(Feedback.fid, Feedback.feedback, Feedback.category, Feedback.anonymous, User.username).join(Student, Feedback.student_id == Student.sid).join(User, User.uid == Student.student_id).filter(Feedback.teacher_id == tid)
+    terms = fts_terms(search)
+    if not terms:
+        return feedback.order_by(Feedback.fid)
+    elif feedback_search_enabled():
+        return feedback.join(feedback_fts, feedback_fts.c.rowid == Feedback.fid).filter(feedback_fts.c.FeedbackSearch.match(terms)).order_by(text("bm25(FeedbackSearch)"), Feedback.fid)
+    else:
+        return feedback.filter(or_(Feedback.category.like("%"+search+"%"), Feedback.feedback.like("%"+search+"%"))).order_by(Feedback.fid)
+
+
+def search_feedback(tid, search, page = 1):
+    # returns up to FEEDBACK_PAGE_SIZE + 1 rows so callers can tell if there is a next page
+    return search_feedback_query(tid, search).limit(FEEDBACK_PAGE_SIZE + 1).offset((max(page, 1) - 1) * FEEDBACK_PAGE_SIZE).all()
+
+
+# SCHEMA UPGRADES
+# create_all only adds missing tables, so indexes declared on existing tables
+# are created one by one here. Safe to run repeatedly.
+
+
+def upgrade_db():
+    db.create_all()
+    create_feedback_search()
+    created = []
+    with db.engine.begin() as conn:
+        existing = {name for (name,) in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))} if conn.dialect.name == "sqlite" else set()
+        for db_table in db.metadata.sorted_tables:
+            for index in db_table.indexes:
+                if index.name not in existing:
+                    index.create(bind = conn, checkfirst = True)
+                    created.append(index.name)
+    # pooled connections keep statements prepared against the old schema
+    db.session.remove()
+    db.engine.dispose()
+    return created
+
+
+def index_checks():
+    # the queries the hot routes run, built by the same helpers with representative ids
+    return [
+        ("login", User.query.filter_by(username = "user")),
+        ("login (principal)", principal_query("user", 1)),
+        ("grades (students)", course_students_query(1)),
+        ("grades", student_grades_query(1)),
+        ("grades (regrades)", open_regrades_query(1)),
+        ("edit_grade", grade_student_query(1, 1)),
+        ("feedback", teacher_feedback_query(1)),
+        ("feedback (search)", search_feedback_query(1, "grade")),
+        ("dailysmile", smile_page_query()),
+        ("dailysmile (next page)", smile_page_query((datetime(2000, 1, 1), 1))),
+        ("assignments", course_query(Assignment, 1)),
+        ("add_asmt", asmt_grade_rows(1, 1)),
+        ("regrades", regrade_counts_query((1,))),
+        ("regrades (queue)", regrade_queue_query((1,))),
+        ("grading status", grading_status_query()),
+        ("gradebook", gradebook_query(course_query(Assignment, 1).all(), 1)),
+    ]
+
+
+def query_plan(query):
+    statement = query.statement if hasattr(query, "statement") else query
+    sql = str(statement.compile(dialect = db.engine.dialect, compile_kwargs = {"literal_binds": True}))
+    return [row[-1] for row in db.session.execute(text("EXPLAIN QUERY PLAN " + sql))]
+
+
+def check_query_plans():
+    # returns (route, plan line) for every full table scan of a hot table
+    hot = ("User", "Teacher", "Student", "Grade", "Regrade", "Feedback", "Smile")
+    scans = []
+    for route, query in index_checks():
+        for line in query_plan(query):
+            words = line.replace("SCAN TABLE ", "SCAN ").split()
+            if words[0] == "SCAN" and words[1] in hot and "INDEX" not in words:
+                scans.append((route, line))
+    return scans
+
+
+@app.before_first_request
+def create_missing_tables():
+    db.create_all()
+    create_feedback_search()
+
+
+# CLI COMMANDS
+@app.cli.command("upgrade-db")
+def upgrade_db_command():
+    """Create missing tables and indexes in an existing database."""
+    created = upgrade_db()
+    print(f"Created {len(created)} indexes: {', '.join(created) or 'none'}")
+
+
+@app.cli.command("rebuild-feedback-search")
+def rebuild_feedback_search_command():
+    """Backfill the feedback full-text index from the Feedback table."""
+    count = rebuild_feedback_search()
+    print(f"Indexed {count} feedback entries.")
+
+
+@app.cli.command("check-indexes")
+def check_indexes_command():
+    """Fail if a hot route's main query scans a table instead of using an index."""
+    try:
+        scans = check_query_plans()
+    except SQLAlchemyError as e:
+        print(f"Cannot plan route queries ({e.orig}); run 'flask upgrade-db' first.")
+        raise SystemExit(1)
+    for route, line in scans:
+        print(f"{route}: {line}")
+    print(f"{len(scans)} table scans in route queries.")
+    if scans:
+        raise SystemExit(1)
+
+
+@app.cli.command("rebuild-summaries")
+def rebuild_summaries_command():
+    """Recompute every student's grade summary from the Grade table."""
+    count = rebuild_grade_summaries()
+    print(f"Rebuilt {count} grade summaries.")
+
+
+@app.cli.command("rebuild-regrade-counts")
+def rebuild_regrade_counts_command():
+    """Recount open regrade requests for every assignment."""
+    count = rebuild_regrade_counts()
+    print(f"Rebuilt regrade counts for {count} assignments.")
+
+
+@app.cli.command("check-summaries")
+def check_summaries_command():
+    """Compare stored grade summaries with a fresh calculation."""
+    mismatches = check_grade_summaries()
+    for sid, stored, computed in mismatches:
+        print(f"Student {sid}: stored {stored}, computed {computed}")
+    print(f"{len(mismatches)} mismatched grade summaries.")
+    if mismatches:
+        raise SystemExit(1)
+
+
+@app.cli.command("revoke-sessions")
+@click.argument("username")
+def revoke_sessions_command(username):
+    """Sign a user out of every server-side session."""
+    count = revoke_user_sessions(username)
+    print(f"Revoked {count} sessions for {username}.")
+
+
+@app.cli.command("import-roster")
+@click.argument("path", type = click.Path(exists = True, dir_okay = False))
+@click.option("--course", "course_id", type = int, default = None, help = "Course to enrol into (default: DEFAULT_COURSE_ID).")
+@click.option("--chunk-size", type = int, default = None, help = "Rows per transaction (default: IMPORT_CHUNK_SIZE).")
+@click.option("--checkpoint", type = click.Path(dir_okay = False), default = None, help = "Checkpoint file (default: PATH.checkpoint).")
+@click.option("--restart", is_flag = True, help = "Ignore an existing checkpoint and start from the first row.")
+def import_roster_command(path, course_id, chunk_size, checkpoint, restart):
+    """Stream a registrar CSV of students and their marks into a course."""
+    course_id = course_id or app.config['DEFAULT_COURSE_ID']
+    if Course.query.get(course_id) is None:
+        raise click.ClickException(f"Course {course_id} does not exist.")
+    totals = [0, 0, 0, 0]
+    try:
+        for progress in import_roster(path, course_id, checkpoint, chunk_size, restart):
+            for number, message in progress.errors:
+                click.echo(f"Row {number}: {message}", err = True)
+            totals = [total + count for total, count in zip(totals, (progress.users, progress.students, progress.marks, len(progress.errors)))]
+            click.echo(f"Row {progress.row}: {totals[0]} users, {totals[1]} students, {totals[2]} marks, {totals[3]} errors")
+    except CheckpointMismatch as e:
+        raise click.ClickException(f"{e}; use --restart to import from the first row.")
+    click.echo("Import complete.")
 
 
 if __name__ == '__main__':
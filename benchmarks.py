@@ -0,0 +1,615 @@
+
+# Benchmarks for app.py. Every benchmark runs against a scratch SQLite file,
+# never the checked in assignment3.db.
+#
+#   python benchmarks.py fanout --students 10000
+#   python benchmarks.py generate --db big.db --students 50000 --asmts 40
+#   python benchmarks.py routes --db big.db --save baseline.json
+import os
+import sys
+import json
+import random
+import time
+import tempfile
+import tracemalloc
+import csv
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import aliased
+
+
+def load_app(path = None):
+    # app.py reads DATABASE_URL at import time, so it has to be set first
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix = ".db")
+        os.close(fd)
+        os.remove(path)
+    os.environ['DATABASE_URL'] = "sqlite:///" + os.path.abspath(path)
+    # one process, so sessions can stay in memory and query counts stay per route
+    os.environ.setdefault('SESSION_STORE', "memory")
+    import app as module
+    with module.app.app_context():
+        module.db.create_all()
+    return module, path
+
+
+class CommitCounter:
+    def __init__(self, engine):
+        self.commits = 0
+        event.listen(engine, "commit", self.on_commit)
+
+    def on_commit(self, conn):
+        self.commits += 1
+
+    def reset(self):
+        self.commits = 0
+
+
+def seed_course(m, students):
+    db = m.db
+    db.session.add(m.Course(cid = 1, code = "CSCB63", name = "Benchmark Course", semester = "Winter", year = "2022"))
+    db.session.flush()
+    users = [{"firstname": "S", "lastname": str(i), "username": f"s{i}", "email": f"s{i}@example.com", "password": "x"} for i in range(students)]
+    db.session.execute(insert(m.User), users)
+    uids = [uid for (uid,) in db.session.query(m.User.uid).order_by(m.User.uid)]
+    m.enroll_students(uids, course_id = 1)
+    db.session.commit()
+
+
+def seed_instructor(m, username = "instructor0"):
+    # routes authorize on the principal, so benchmark sessions need a real instructor
+    db = m.db
+    db.session.execute(insert(m.User), [{"firstname": "I", "lastname": "0", "username": username, "email": f"{username}@example.com", "password": "x"}])
+    uid = db.session.query(m.User.uid).filter(m.User.username == username).scalar()
+    db.session.execute(insert(m.Teacher), [{"course_id": 1, "teacher_id": uid}])
+    db.session.commit()
+    return username
+
+
+def legacy_add_asmt_db(m, new_asmt):
+    # the per-row commit loop add_asmt_db used before the bulk fan-out
+    db = m.db
+    asmt = m.Assignment(name = new_asmt[0], due = new_asmt[1], outof = new_asmt[2], weight = new_asmt[3], course_id = 1)
+    db.session.add(asmt)
+    db.session.commit()
+
+    students = m.Student.query.filter_by(course_id = 1).all()
+    asmt_db = m.Assignment.query.filter_by(name = new_asmt[0]).first()
+    for student in students:
+        grade = m.Grade(student_id = student.sid, asmt_id = asmt_db.aid)
+        db.session.add(grade)
+        db.session.commit()
+
+
+def timed(counter, fn, *args):
+    counter.reset()
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start, counter.commits
+
+
+def report(label, seconds, commits, rows):
+    print(f"{label:<10} {rows:>8} grade rows  {commits:>8} commits  {seconds:>9.3f} s")
+
+
+def bench_fanout(args):
+    m, path = load_app(args.db)
+    with m.app.app_context():
+        seed_course(m, args.students)
+        counter = CommitCounter(m.db.engine)
+        due = datetime(2022, 4, 1, 23, 59)
+
+        if not args.skip_legacy:
+            seconds, commits = timed(counter, legacy_add_asmt_db, m, ("Legacy", due, 100, 10))
+            report("legacy", seconds, commits, args.students)
+
+        seconds, commits = timed(counter, m.add_asmt_db, ("Bulk", due, 100, 10))
+        report("bulk", seconds, commits, args.students)
+    print("database:", path)
+
+
+WORDS = "labs lectures tutorials midterm final grading regrade handwriting slides pacing examples office hours quiz feedback instructor course fun hard clear".split()
+TOPICS = [f"topic{i}" for i in range(5000)]
+
+
+def seed_feedback(m, rows, teachers = 4, students = 100):
+    db = m.db
+    db.session.execute(insert(m.User), [{"firstname": "U", "lastname": str(i), "username": f"u{i}", "email": f"u{i}@example.com", "password": "x"} for i in range(teachers + students)])
+    db.session.execute(insert(m.Teacher), [{"course_id": 1, "teacher_id": uid} for uid in range(1, teachers + 1)])
+    db.session.execute(insert(m.Student), [{"course_id": 1, "student_id": uid} for uid in range(teachers + 1, teachers + students + 1)])
+    rand = random.Random(3)
+    batch = []
+    for i in range(rows):
+        batch.append({"teacher_id": rand.randint(1, teachers), "student_id": rand.randint(1, students), "category": rand.choice(WORDS), "anonymous": True, "feedback": " ".join(rand.choices(WORDS, k = 10) + rand.choices(TOPICS, k = 2))})
+        if len(batch) == 10000:
+            db.session.execute(insert(m.Feedback), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(m.Feedback), batch)
+    db.session.commit()
+
+
+def bench_search(args):
+    m, path = load_app(args.db)
+    with m.app.app_context():
+        m.db.session.add(m.Course(cid = 1, code = "CSCB63", name = "Benchmark Course", semester = "Winter", year = "2022"))
+        m.create_feedback_search()
+        seed_feedback(m, args.rows)
+        for term in ["topic42", "topic42 handwriting", "grade", "handwriting"]:
+            like = m.Feedback.query.filter(m.Feedback.teacher_id == 1).filter(m.or_(m.Feedback.category.like("%"+term+"%"), m.Feedback.feedback.like("%"+term+"%"))).order_by(m.Feedback.fid).limit(m.FEEDBACK_PAGE_SIZE + 1)
+            start = time.perf_counter()
+            like.all()
+            like_ms = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            m.search_feedback(1, term)
+            fts_ms = (time.perf_counter() - start) * 1000
+            print(f"{term!r:<22} like {like_ms:>8.2f} ms   fts5 {fts_ms:>8.2f} ms")
+    print("database:", path)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0
+
+
+def bench_login(args):
+    # BCRYPT_* settings are read when app.py is imported
+    os.environ['BCRYPT_WORKERS'] = str(args.workers)
+    os.environ['BCRYPT_LOG_ROUNDS'] = str(args.rounds)
+    m, path = load_app(args.db)
+    with m.app.app_context():
+        m.db.session.add(m.Course(cid = 1, code = "CSCB63", name = "Benchmark Course", semester = "Winter", year = "2022"))
+        pw_hash = m.hash_password_job("password", args.rounds)
+        m.db.session.execute(insert(m.User), [{"firstname": "S", "lastname": str(i), "username": f"s{i}", "email": f"s{i}@example.com", "password": pw_hash} for i in range(args.users)])
+        m.enroll_students(range(1, args.users + 1), course_id = 1)
+        m.db.session.commit()
+
+    local = threading.local()
+    def login(i):
+        if not hasattr(local, "client"):
+            local.client = m.app.test_client()
+        start = time.perf_counter()
+        response = local.client.post("/login", data = {"username": f"s{i % args.users}", "password": "password"})
+        local.client.cookie_jar.clear()
+        return response.status_code, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = args.threads) as threads:
+        results = list(threads.map(login, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    latencies = [seconds * 1000 for status, seconds in results if status == 302]
+    statuses = {}
+    for status, seconds in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    print(f"workers {args.workers}  threads {args.threads}  rounds {args.rounds}")
+    print(f"{args.requests} logins in {elapsed:.2f} s ({args.requests / elapsed:.1f}/s)  statuses {statuses}")
+    print(f"p50 {percentile(latencies, 50):.1f} ms  p95 {percentile(latencies, 95):.1f} ms  p99 {percentile(latencies, 99):.1f} ms")
+    print("database:", path)
+
+
+def seed_gradebook(m, students, asmts):
+    db = m.db
+    due = datetime(2022, 4, 1, 23, 59)
+    db.session.execute(insert(m.Assignment), [{"course_id": 1, "name": f"Assignment {i}", "outof": 100, "weight": 100 / asmts, "due": due} for i in range(asmts)])
+    seed_course(m, students)
+    db.session.execute(m.Grade.__table__.update().values(grade = 50))
+    m.rebuild_grade_summaries()
+
+
+def bench_mixed(args):
+    # DB_PROFILE is read when app.py is imported
+    os.environ['DB_PROFILE'] = args.profile
+    m, path = load_app(args.db)
+    with m.app.app_context():
+        seed_gradebook(m, args.students, args.asmts)
+        gids = [gid for (gid,) in m.db.session.query(m.Grade.gid)]
+        print("engine:", m.db.engine.url, type(m.db.engine.pool).__name__)
+
+    deadline = time.perf_counter() + args.seconds
+    lock = threading.Lock()
+    results = {"read": [], "write": [], "locked": 0}
+
+    def worker(seed):
+        rand = random.Random(seed)
+        with m.app.app_context():
+            while time.perf_counter() < deadline:
+                kind = "write" if rand.random() < args.write_ratio else "read"
+                start = time.perf_counter()
+                try:
+                    if kind == "write":
+                        grade = m.Grade.query.get(rand.choice(gids))
+                        newgrade = float(rand.randint(0, 100))
+                        m.change_grade(grade, newgrade)
+                        m.db.session.commit()
+                    else:
+                        sid = rand.randint(1, args.students)
+                        m.Grade.query.join(m.Assignment, m.Assignment.aid == m.Grade.asmt_id).add_columns(m.Assignment.name, m.Grade.grade).filter(m.Grade.student_id == sid).all()
+                        m.grade_summary(sid)
+                        m.db.session.commit()
+                except OperationalError:
+                    m.db.session.rollback()
+                    with lock:
+                        results["locked"] += 1
+                    continue
+                with lock:
+                    results[kind].append((time.perf_counter() - start) * 1000)
+            m.db.session.remove()
+
+    threads = [threading.Thread(target = worker, args = (i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(f"profile {args.profile}  threads {args.threads}  write ratio {args.write_ratio}")
+    for kind in ("read", "write"):
+        latencies = results[kind]
+        print(f"{kind:<6} {len(latencies) / args.seconds:>8.1f}/s  p50 {percentile(latencies, 50):.2f} ms  p95 {percentile(latencies, 95):.2f} ms  p99 {percentile(latencies, 99):.2f} ms")
+    print(f"database is locked errors: {results['locked']}")
+    print("database:", path)
+
+
+def bench_bulkgrades(args):
+    m, path = load_app(args.db)
+    with m.app.app_context():
+        seed_gradebook(m, args.students, 1)
+        m.db.session.execute(m.Grade.__table__.update().values(grade = None))
+        m.rebuild_grade_summaries()
+        username = seed_instructor(m)
+    rand = random.Random(7)
+    rows = [{"sid": sid, "aid": 1, "grade": rand.randint(0, 100)} for sid in range(1, args.students + 1)]
+
+    client = m.app.test_client()
+    with client.session_transaction() as sess:
+        sess['type'] = "Instructor"
+        sess['username'] = username
+    start = time.perf_counter()
+    response = client.post("/bulk_grades", json = rows)
+    elapsed = time.perf_counter() - start
+    body = response.get_json()
+    print(f"{body['applied']} applied, {body['failed']} failed in {elapsed:.3f} s ({body['applied'] / elapsed:.0f} grades/s)")
+    with m.app.app_context():
+        print("summary mismatches:", len(m.check_grade_summaries()))
+    print("database:", path)
+
+
+# ROSTER IMPORT
+# Writes a registrar-style CSV and streams it through import_roster, reporting
+# rows per second and the peak Python memory, which should not grow with --rows.
+def write_roster(path, rows, asmts, seed = 1):
+    rand = random.Random(seed)
+    with open(path, "w", newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(["username", "firstname", "lastname", "email", "password"] + [f"Assignment {i}" for i in range(asmts)])
+        for i in range(rows):
+            marks = ["" if rand.random() < 0.1 else rand.randint(0, 100) for aid in range(asmts)]
+            writer.writerow([f"reg{i}", "Student", str(i), f"reg{i}@example.com", "password" if i % 10 == 0 else ""] + marks)
+
+
+def bench_import(args):
+    m, path = load_app(args.db)
+    m.app.config['BCRYPT_LOG_ROUNDS'] = args.rounds
+    with m.app.app_context():
+        m.db.session.add(m.Course(cid = 1, code = "CSCB63", name = "Benchmark Course", semester = "Winter", year = "2022"))
+        m.db.session.execute(insert(m.Assignment), [{"course_id": 1, "name": f"Assignment {i}", "outof": 100, "weight": 100 / args.asmts, "due": datetime(2022, 4, 1, 23, 59)} for i in range(args.asmts)])
+        m.db.session.commit()
+    fd, roster = tempfile.mkstemp(suffix = ".csv")
+    os.close(fd)
+    write_roster(roster, args.rows, args.asmts)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with m.app.app_context():
+        for progress in m.import_roster(roster, 1, chunk_size = args.chunk_size, restart = True):
+            pass
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{args.rows} rows in {elapsed:.1f} s ({args.rows / elapsed:.0f} rows/s), peak {peak / 2 ** 20:.1f} MiB")
+        print("summary mismatches:", len(m.check_grade_summaries()))
+    os.remove(roster)
+    print("database:", path)
+
+
+# SYNTHETIC DATA
+# generate_dataset fills every table at a chosen size from a seeded RNG, so the
+# same arguments always produce the same database.
+def chunked(rows, size = 20000):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert_rows(m, model, rows):
+    for batch in chunked(rows):
+        m.db.session.execute(insert(model), batch)
+
+
+def generate_dataset(m, students = 1000, asmts = 10, teachers = 4, feedback = 2, regrade_rate = 0.02, ungraded_rate = 0.1, smiles = 200, seed = 1):
+    rand = random.Random(seed)
+    db = m.db
+    pw_hash = m.hash_password_job("password", 4)
+    db.session.add(m.Course(cid = 1, code = "CSCB63", name = "Benchmark Course", semester = "Winter", year = "2022"))
+    insert_rows(m, m.User, ({"uid": i + 1, "firstname": "Instructor", "lastname": str(i), "username": f"instructor{i}", "email": f"instructor{i}@example.com", "password": pw_hash} for i in range(teachers)))
+    insert_rows(m, m.User, ({"uid": teachers + i + 1, "firstname": "Student", "lastname": str(i), "username": f"student{i}", "email": f"student{i}@example.com", "password": pw_hash} for i in range(students)))
+    insert_rows(m, m.Teacher, ({"tid": i + 1, "course_id": 1, "teacher_id": i + 1} for i in range(teachers)))
+    insert_rows(m, m.Student, ({"sid": i + 1, "course_id": 1, "student_id": teachers + i + 1} for i in range(students)))
+
+    start = datetime(2022, 1, 10, 23, 59)
+    outofs = [rand.choice([10, 35, 50, 100]) for i in range(asmts)]
+    insert_rows(m, m.Assignment, ({"aid": i + 1, "course_id": 1, "name": f"Assignment {i + 1}", "outof": outofs[i], "weight": round(100 / asmts, 2), "due": start + timedelta(days = 3 * i)} for i in range(asmts)))
+
+    def grades():
+        for sid in range(1, students + 1):
+            for aid in range(1, asmts + 1):
+                grade = None if rand.random() < ungraded_rate else float(rand.randint(0, outofs[aid - 1]))
+                yield {"gid": (sid - 1) * asmts + aid, "student_id": sid, "asmt_id": aid, "grade": grade}
+    insert_rows(m, m.Grade, grades())
+
+    regrades = int(students * asmts * regrade_rate)
+    insert_rows(m, m.Regrade, ({"grade_id": rand.randint(1, students * asmts), "reason": " ".join(rand.choices(WORDS, k = 8)), "resolved": rand.random() < 0.5} for i in range(regrades)))
+    insert_rows(m, m.Feedback, ({"teacher_id": rand.randint(1, teachers), "student_id": sid, "category": rand.choice(WORDS), "anonymous": rand.random() < 0.5, "feedback": " ".join(rand.choices(WORDS, k = 10) + rand.choices(TOPICS, k = 2))} for sid in range(1, students + 1) for i in range(feedback)))
+    insert_rows(m, m.Smile, ({"title": f"Smile {i}", "link": "https://example.com", "type": "image", "desc": "", "date_posted": start + timedelta(hours = i), "posted_by": rand.randint(1, teachers)} for i in range(smiles)))
+    db.session.commit()
+
+    m.upgrade_db()
+    m.rebuild_feedback_search()
+    m.rebuild_grade_summaries()
+    m.rebuild_regrade_counts()
+
+
+def bench_generate(args):
+    if not args.db:
+        raise SystemExit("generate needs --db to say where the database goes")
+    m, path = load_app(args.db)
+    start = time.perf_counter()
+    with m.app.app_context():
+        generate_dataset(m, args.students, args.asmts, args.teachers, args.feedback, args.regrade_rate, args.ungraded_rate, args.smiles, args.seed)
+    print(f"generated {args.students} students x {args.asmts} assignments in {time.perf_counter() - start:.1f} s")
+    print("database:", path)
+
+
+# ROUTE BENCHMARKS
+# Drives the Flask test client against the heavy routes of a generated
+# database and reports latency percentiles and SQL statements per request.
+# With --check the run fails when a route's median statement count goes over
+# its budget in QUERY_BUDGETS.
+QUERY_BUDGETS = {
+    "grades": 4,
+    "grades (student)": 3,
+    "edit_grade": 5,
+    "edit_grade (post)": 4,
+    "regrades": 2,
+    "feedback": 1,
+    "feedback search": 1,
+    "dailysmile": 1,
+    "add_asmt": 3,
+}
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.queries = 0
+        event.listen(engine, "before_cursor_execute", self.on_execute)
+
+    def on_execute(self, *args):
+        self.queries += 1
+
+
+def route_requests(rand, students, gids, iterations):
+    # (name, request factory, iterations); each request is (session type, username, method, url, form)
+    def add_asmt():
+        return {"name": f"Bench {time.time_ns()}", "due": "2022-04-30T23:59", "outof": "100", "weight": "1"}
+    return [
+        ("grades", lambda: ("Instructor", "instructor0", "GET", f"/grades?sid={rand.randint(1, students)}", None), iterations),
+        ("grades (student)", lambda: ("Student", f"student{rand.randrange(students)}", "GET", "/grades", None), iterations),
+        ("edit_grade", lambda: ("Instructor", "instructor0", "GET", f"/edit_grade?gid={rand.choice(gids)}", None), iterations),
+        ("edit_grade (post)", lambda: ("Instructor", "instructor0", "POST", f"/edit_grade?gid={rand.choice(gids)}", {"newgrade": "5"}), iterations),
+        ("regrades", lambda: ("Instructor", "instructor0", "GET", "/regrades", None), iterations),
+        ("feedback", lambda: ("Instructor", f"instructor{rand.randrange(4)}", "GET", "/feedback", None), iterations),
+        ("feedback search", lambda: ("Instructor", "instructor0", "POST", "/feedback", {"search": rand.choice(TOPICS)}), iterations),
+        ("dailysmile", lambda: (None, None, "GET", "/dailysmile", None), iterations),
+        ("add_asmt", lambda: ("Instructor", "instructor0", "POST", "/add_asmt", add_asmt()), max(1, iterations // 20)),
+    ]
+
+
+def bench_routes(args):
+    m, path = load_app(args.db)
+    with m.app.app_context():
+        if m.Student.query.first() is None:
+            generate_dataset(m, args.students, args.asmts, seed = args.seed)
+        students = m.Student.query.count()
+        gids = [gid for (gid,) in m.db.session.query(m.Grade.gid).limit(100000)]
+        counter = QueryCounter(m.db.engine)
+
+    rand = random.Random(args.seed)
+    client = m.app.test_client()
+    client.get("/home")
+    results = {}
+    for name, make_request, iterations in route_requests(rand, students, gids, args.iterations):
+        latencies = []
+        queries = []
+        errors = 0
+        for i in range(iterations):
+            role, username, method, url, form = make_request()
+            with client.session_transaction() as sess:
+                sess.clear()
+                if role:
+                    sess['type'] = role
+                    sess['username'] = username
+            counter.queries = 0
+            start = time.perf_counter()
+            response = client.open(url, method = method, data = form)
+            latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(counter.queries)
+            if response.status_code >= 400:
+                errors += 1
+        results[name] = {
+            "requests": iterations,
+            "errors": errors,
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p95_ms": round(percentile(latencies, 95), 3),
+            "p99_ms": round(percentile(latencies, 99), 3),
+            "queries_per_request": round(sum(queries) / len(queries), 2),
+            "queries_p50": percentile(queries, 50),
+        }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["routes"]
+    print(f"{'route':<20} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8} {'errors':>7}" + ("  p95 vs baseline" if baseline else ""))
+    for name, result in results.items():
+        line = f"{name:<20} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['queries_per_request']:>8.1f} {result['errors']:>7}"
+        if baseline and name in baseline and baseline[name]["p95_ms"]:
+            line += f"  {result['p95_ms'] / baseline[name]['p95_ms']:>6.2f}x"
+        print(line)
+
+    over = [(name, result["queries_p50"]) for name, result in results.items() if result["queries_p50"] > QUERY_BUDGETS.get(name, float("inf"))]
+    for name, queries in over:
+        print(f"{name}: {queries} queries, budget {QUERY_BUDGETS[name]}")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"students": students, "iterations": args.iterations, "seed": args.seed, "routes": results}, file, indent = 2)
+        print("saved:", args.save)
+    print("database:", path)
+    if args.check and over:
+        raise SystemExit(1)
+
+
+# LIST VIEW MEMORY
+# Loads each list view's rows both as ORM entities with add_columns, the way
+# the routes used to, and as the column-only rows they use now, and reports
+# traced memory and load time per 10k rows.
+def list_queries(m):
+    db = m.db
+    s_user = aliased(m.User)
+    return [
+        ("grades",
+            m.Grade.query.join(m.Assignment, m.Assignment.aid == m.Grade.asmt_id).add_columns(m.Assignment.aid, m.Assignment.name, m.Assignment.outof, m.Assignment.weight, m.Assignment.due, m.Grade.gid, m.Grade.grade),
+            db.session.query(m.Assignment.aid, m.Assignment.name, m.Assignment.outof, m.Assignment.weight, m.Assignment.due, m.Grade.gid, m.Grade.grade).join(m.Assignment, m.Assignment.aid == m.Grade.asmt_id)),
+        ("regrades",
+            m.Regrade.query.join(m.Grade, m.Grade.gid == m.Regrade.grade_id).join(m.Student, m.Student.sid == m.Grade.student_id).join(m.Assignment, m.Assignment.aid == m.Grade.asmt_id).join(s_user, s_user.uid == m.Student.student_id).add_columns(m.Regrade.rid, m.Grade.gid, m.Regrade.resolved, m.Student.sid, s_user.firstname, s_user.lastname, m.Assignment.name, m.Assignment.outof, m.Grade.grade, m.Assignment.weight, m.Regrade.reason),
+            db.session.query(m.Regrade.rid, m.Grade.gid, m.Regrade.resolved, m.Student.sid, s_user.firstname, s_user.lastname, m.Assignment.name, m.Assignment.outof, m.Grade.grade, m.Assignment.weight, m.Regrade.reason).select_from(m.Regrade).join(m.Grade, m.Grade.gid == m.Regrade.grade_id).join(m.Student, m.Student.sid == m.Grade.student_id).join(m.Assignment, m.Assignment.aid == m.Grade.asmt_id).join(s_user, s_user.uid == m.Student.student_id)),
+        ("feedback",
+            m.Feedback.query.join(m.Student, m.Feedback.student_id == m.Student.sid).join(m.User, m.User.uid == m.Student.student_id).add_columns(m.Feedback.feedback, m.Feedback.category, m.Feedback.anonymous, m.User.username),
+            db.session.query(m.Feedback.fid, m.Feedback.feedback, m.Feedback.category, m.Feedback.anonymous, m.User.username).join(m.Student, m.Feedback.student_id == m.Student.sid).join(m.User, m.User.uid == m.Student.student_id)),
+        ("smiles",
+            m.Smile.query.join(m.Teacher, m.Teacher.tid == m.Smile.posted_by).join(m.User, m.User.uid == m.Teacher.teacher_id).add_columns(m.User.firstname, m.User.lastname, m.Smile.title, m.Smile.link, m.Smile.type, m.Smile.desc, m.Smile.posted_by, m.Smile.date_posted, m.Smile.hid),
+            db.session.query(m.User.firstname, m.User.lastname, m.Smile.title, m.Smile.link, m.Smile.type, m.Smile.desc, m.Smile.posted_by, m.Smile.date_posted, m.Smile.hid).select_from(m.Smile).join(m.Teacher, m.Teacher.tid == m.Smile.posted_by).join(m.User, m.User.uid == m.Teacher.teacher_id)),
+    ]
+
+
+def load_rows(m, query, limit):
+    m.db.session.expunge_all()
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = query.limit(limit).all()
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return len(rows), size, elapsed
+
+
+def bench_rows(args):
+    m, path = load_app(args.db)
+    with m.app.app_context():
+        if m.Student.query.first() is None:
+            generate_dataset(m, args.students, args.asmts, smiles = args.smiles, seed = args.seed)
+        print(f"{'list':<10} {'rows':>7} {'entity KiB/10k':>15} {'row KiB/10k':>12} {'entity ms/10k':>14} {'row ms/10k':>11}")
+        for name, entities, columns in list_queries(m):
+            count, entity_size, entity_time = load_rows(m, entities, args.limit)
+            count, row_size, row_time = load_rows(m, columns, args.limit)
+            scale = 10000 / max(count, 1)
+            print(f"{name:<10} {count:>7} {entity_size * scale / 1024:>15.0f} {row_size * scale / 1024:>12.0f} {entity_time * scale * 1000:>14.1f} {row_time * scale * 1000:>11.1f}")
+    print("database:", path)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmarks for the Assignment 3 app")
+    parser.add_argument("--db", help = "scratch SQLite file to use (default: a new temporary file)")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    fanout = commands.add_parser("fanout", help = "grade fan-out cost of adding an assignment")
+    fanout.add_argument("--students", type = int, default = 10000)
+    fanout.add_argument("--skip-legacy", action = "store_true", help = "only time the bulk path")
+    fanout.set_defaults(func = bench_fanout)
+
+    search = commands.add_parser("search", help = "feedback search latency, LIKE against FTS5")
+    search.add_argument("--rows", type = int, default = 200000)
+    search.set_defaults(func = bench_search)
+
+    login = commands.add_parser("login", help = "concurrent logins through the bcrypt worker pool")
+    login.add_argument("--users", type = int, default = 100)
+    login.add_argument("--requests", type = int, default = 400)
+    login.add_argument("--threads", type = int, default = 16)
+    login.add_argument("--workers", type = int, default = os.cpu_count() or 1, help = "bcrypt processes, 0 hashes inline")
+    login.add_argument("--rounds", type = int, default = 12)
+    login.set_defaults(func = bench_login)
+
+    mixed = commands.add_parser("mixed", help = "concurrent grade reads and edits")
+    mixed.add_argument("--profile", choices = ["production", "basic"], default = "production")
+    mixed.add_argument("--students", type = int, default = 2000)
+    mixed.add_argument("--asmts", type = int, default = 10)
+    mixed.add_argument("--threads", type = int, default = 16)
+    mixed.add_argument("--seconds", type = float, default = 10)
+    mixed.add_argument("--write-ratio", type = float, default = 0.2)
+    mixed.set_defaults(func = bench_mixed)
+
+    bulkgrades = commands.add_parser("bulkgrades", help = "one /bulk_grades request marking a whole class")
+    bulkgrades.add_argument("--students", type = int, default = 5000)
+    bulkgrades.set_defaults(func = bench_bulkgrades)
+
+    importer = commands.add_parser("import", help = "stream a registrar CSV through import_roster")
+    importer.add_argument("--rows", type = int, default = 50000)
+    importer.add_argument("--asmts", type = int, default = 10)
+    importer.add_argument("--chunk-size", type = int, default = 1000)
+    importer.add_argument("--rounds", type = int, default = 4, help = "bcrypt rounds for the rows that carry a password")
+    importer.set_defaults(func = bench_import)
+
+    generate = commands.add_parser("generate", help = "fill a database with synthetic course data")
+    generate.add_argument("--students", type = int, default = 50000)
+    generate.add_argument("--asmts", type = int, default = 40)
+    generate.add_argument("--teachers", type = int, default = 8)
+    generate.add_argument("--feedback", type = int, default = 2, help = "feedback entries per student")
+    generate.add_argument("--regrade-rate", type = float, default = 0.02)
+    generate.add_argument("--ungraded-rate", type = float, default = 0.1)
+    generate.add_argument("--smiles", type = int, default = 500)
+    generate.add_argument("--seed", type = int, default = 1)
+    generate.set_defaults(func = bench_generate)
+
+    routes = commands.add_parser("routes", help = "latency and queries per request for the heavy routes")
+    routes.add_argument("--students", type = int, default = 2000, help = "size of the dataset generated when --db is empty")
+    routes.add_argument("--asmts", type = int, default = 10)
+    routes.add_argument("--iterations", type = int, default = 100)
+    routes.add_argument("--seed", type = int, default = 1)
+    routes.add_argument("--save", help = "write the results to this JSON file")
+    routes.add_argument("--compare", help = "JSON results from an earlier run to compare against")
+    routes.add_argument("--check", action = "store_true", help = "exit 1 when a route goes over its query budget")
+    routes.set_defaults(func = bench_routes)
+
+    rows = commands.add_parser("rows", help = "memory and time per 10k rows for the list views, entities against column rows")
+    rows.add_argument("--students", type = int, default = 5000, help = "size of the dataset generated when --db is empty")
+    rows.add_argument("--asmts", type = int, default = 10)
+    rows.add_argument("--smiles", type = int, default = 10000)
+    rows.add_argument("--limit", type = int, default = 50000)
+    rows.add_argument("--seed", type = int, default = 1)
+    rows.set_defaults(func = bench_rows)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())